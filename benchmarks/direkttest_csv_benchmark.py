@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Benchmark for tools.direkttest_csv.csv_from_excel
+# Run from the repository root: python -m benchmarks.direkttest_csv_benchmark
+# Writes a synthetic direkttest workbook and converts it with the streaming
+# openpyxl converter and the old pandas one. Each converter runs in its own
+# process so the peak RSS reported is its own.
+
+import argparse
+import datetime
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import openpyxl
+from tools.direkttest_csv import csv_from_excel, csv_from_excel_pandas
+
+HEADER = ["Provnummer", "Personnummer", "Provtagningsdatum", "Resultat", "Ct", "Kommentar"]
+
+
+def arg():
+    parser = argparse.ArgumentParser(prog="direkttest_csv_benchmark.py")
+    parser.add_argument("-r", "--rows", type=int, default=500000,
+                        help="number of rows in the workbook")
+    parser.add_argument("--skip-pandas", action="store_true",
+                        help="only time the streaming converter")
+    args = parser.parse_args()
+    return args
+
+
+def make_workbook(path, rows):
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(HEADER)
+    for i in range(rows):
+        # Every 7th comment and every 11th Ct value empty
+        ws.append([f"DT{i:08d}", f"19{i % 100:02d}0101-{i % 10000:04d}", datetime.datetime(2021, 3, 1 + i % 28),
+                   "Positiv" if i % 3 else "Negativ",
+                   None if i % 11 == 0 else 20 + i % 15,
+                   None if i % 7 == 0 else "ok"])
+    wb.save(path)
+
+
+def run(func, path, queue):
+    start = time.perf_counter()
+    func(path)
+    # ru_maxrss is in kB on Linux
+    queue.put((time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def measure(func, path):
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=run, args=(func, path, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    if proc.exitcode != 0:
+        sys.exit(f"ERROR: {func.__name__} failed")
+    return result
+
+
+def main():
+    args = arg()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        xlsx = os.path.join(tmpdir, "direkttest_benchmark.xlsx")
+        out = xlsx.replace("xlsx", "csv")
+        make_workbook(xlsx, args.rows)
+        print(f"{args.rows} rows, {os.path.getsize(xlsx) / 1024 / 1024:.1f} MB xlsx")
+        print(f"{'converter':>10} {'time (s)':>9} {'peak RSS (MB)':>14}")
+
+        seconds, rss = measure(csv_from_excel, xlsx)
+        print(f"{'streaming':>10} {seconds:9.2f} {rss:14.1f}")
+
+        if not args.skip_pandas:
+            streamed = out + ".streaming"
+            shutil.move(out, streamed)
+            seconds, rss = measure(csv_from_excel_pandas, xlsx)
+            print(f"{'pandas':>10} {seconds:9.2f} {rss:14.1f}")
+            # pandas writes integer columns with empty cells as floats (25.0),
+            # here the Ct column, the other columns should be the same
+            with open(streamed) as a, open(out) as b:
+                differ = sum(1 for x, y in zip(a, b) if x != y)
+            print(f"rows differing from pandas: {differ}")
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
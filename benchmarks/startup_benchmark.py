@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+# Startup benchmark for the command line entry points
+# Run from the repository root: python -m benchmarks.startup_benchmark
+# Imports every entry point in a fresh interpreter with python -X importtime
+# and fails if one of them loads a heavy dependency (pandas, openpyxl,
+# boto3, pysftp, ...) at import time or takes longer than the budget.
+# The heavy modules only have to be installed for the code paths that use them.
+
+import argparse
+import os
+import subprocess
+import sys
+
+ENTRY_POINTS = [
+    "hcp_covid",
+    "nextseq_cronscript",
+    "eurofins_cronscript",
+    "direkttest_cronscript",
+    "pipeline_watcher",
+    "tools.direkttest_csv",
+    "tools.pangolin_fillemptyfield",
+    "tools.pangolin_outputs",
+]
+
+# Must not be imported when an entry point is loaded
+HEAVY = ["pandas", "numpy", "openpyxl", "boto3", "botocore", "NGPinterface", "pysftp", "paramiko", "sample_sheet"]
+
+
+def arg():
+    parser = argparse.ArgumentParser(prog="startup_benchmark.py")
+    parser.add_argument("-m", "--modules", nargs="+", default=ENTRY_POINTS,
+                        help="entry points to import")
+    parser.add_argument("--budget", type=float, default=250,
+                        help="max cumulative import time per entry point in ms")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="imports per entry point, the fastest is reported")
+    args = parser.parse_args()
+    return args
+
+
+# Cumulative import time in ms of each module imported by "import <module>"
+def import_times(module):
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                          cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if proc.returncode != 0:
+        sys.exit(f"ERROR: import {module} failed\n{proc.stderr.splitlines()[-1]}")
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+def main():
+    args = arg()
+
+    print(f"{'entry point':<32} {'import (ms)':>12}  heavy modules")
+    failed = []
+    for module in args.modules:
+        runs = [import_times(module) for _ in range(args.repeat)]
+        best = min(times[module] for times in runs)
+        heavy = sorted({name.split(".")[0] for name in runs[0]} & set(HEAVY))
+        print(f"{module:<32} {best:12.1f}  {', '.join(heavy) or '-'}")
+        if heavy or best > args.budget:
+            failed.append(module)
+
+    if failed:
+        sys.exit(f"ERROR: over the {args.budget:.0f} ms budget or importing heavy modules: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
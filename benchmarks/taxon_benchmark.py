@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Benchmark for tools.taxon.normalise_taxon
+# Run from the repository root: python -m benchmarks.taxon_benchmark
+# Times the vectorized rewrite from 100 to 100k rows and checks that the
+# time per row stays flat (linear scaling) from 10k rows up, below that the
+# fixed pandas overhead per call dominates. The old iterrows() loop is
+# timed for the small sizes only, it is quadratic.
+
+import argparse
+import sys
+import timeit
+import pandas as pd
+from tools.taxon import normalise_taxon
+
+
+def arg():
+    parser = argparse.ArgumentParser(prog="taxon_benchmark.py")
+    parser.add_argument("-s", "--sizes", nargs="+", type=int,
+                        default=[100, 1000, 10000, 100000],
+                        help="number of rows to benchmark")
+    parser.add_argument("--legacy-max", type=int, default=1000,
+                        help="largest size to also time with the old iterrows() loop")
+    parser.add_argument("--linear-min", type=int, default=10000,
+                        help="smallest size used for the linear scaling check")
+    parser.add_argument("--max-ratio", type=float, default=1.5,
+                        help="max allowed time per row, largest vs smallest size of the scaling check")
+    args = parser.parse_args()
+    return args
+
+
+def make_frame(rows):
+    taxon = [f"Consensus_{i:06d}_2021-03-01_01_S{i}.primertrimmed.consensus_threshold_0.75_quality_20" for i in range(rows)]
+    return pd.DataFrame({"taxon": taxon, "lineage": ["B.1.1.7"] * rows})
+
+
+def legacy(df):
+    for i,row in df.iterrows():
+        df["taxon"] = df["taxon"].replace(row["taxon"], "_".join(row["taxon"].split("_")[1:4]))
+    return df
+
+
+def best_of(func, df, repeat=3):
+    return min(timeit.repeat(lambda: func(df.copy()), number=1, repeat=repeat))
+
+
+def main():
+    args = arg()
+
+    print(f"{'rows':>8} {'vectorized (s)':>15} {'us/row':>8} {'iterrows (s)':>13}")
+    per_row = {}
+    for rows in args.sizes:
+        df = make_frame(rows)
+        vec = best_of(normalise_taxon, df)
+        per_row[rows] = vec / rows
+        old = f"{best_of(legacy, df, repeat=1):13.3f}" if rows <= args.legacy_max else f"{'-':>13}"
+        print(f"{rows:>8} {vec:15.4f} {vec / rows * 1e6:8.3f} {old}")
+
+    # Same output as the old loop
+    df = make_frame(100)
+    assert normalise_taxon(df.copy())["taxon"].equals(legacy(df.copy())["taxon"])
+
+    checked = sorted(rows for rows in per_row if rows >= args.linear_min)
+    if len(checked) < 2:
+        sys.exit(f"ERROR: the scaling check needs two sizes of at least {args.linear_min} rows")
+    ratio = per_row[checked[-1]] / per_row[checked[0]]
+    print(f"time per row, {checked[-1]} vs {checked[0]} rows: {ratio:.2f}x (budget {args.max_ratio}x)")
+    if ratio > args.max_ratio:
+        sys.exit("ERROR: normalise_taxon does not scale linearly")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,22 @@
 #!/usr/bin/env python3
 
 import argparse
-import openpyxl
-import pandas as pd
 import os
-import fnmatch
-import glob
 import datetime
+import sys
 import logging
-from NGPinterface.hcp import HCPManager
 from tools import log 
-from tools.check_files import check_files
-from tools.direkttest_csv import csv_from_excel as csv_parse
+from tools.scan_state import ScanState
+from tools.artifact_cache import ArtifactCache
+from tools.stages import StageGraph
+from tools.run_state import fingerprint
+from tools.readiness import settled_files, take_ready
+from tools.direkttest_csv import convert_workbooks
+from tools.hcp_upload import upload_stage, run_pipeline
 
-def arg():
+ERROR_LOG = "/medstore/logs/pipeline_logfiles/sars-cov-2-typing/direkttestwrapper_cronjob.log"
+
+def arg(argv=None):
     parser = argparse.ArgumentParser(prog="direkttest_cronscript.py")
     requiredNamed = parser.add_argument_group('required arguments')
 
@@ -25,7 +28,23 @@ def arg():
                             help="aws secret access key")
     requiredNamed.add_argument("-b", "--bucket",
                             help="bucket name")
-    args = parser.parse_args()
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                            help="number of processes for the per-file conversions")
+    parser.add_argument("--settle-age", type=int, default=300,
+                            help="seconds since the last change before a file is uploaded")
+    parser.add_argument("-w", "--workers", type=int, default=4,
+                            help="number of parallel HCP uploads")
+    parser.add_argument("--retries", type=int, default=3,
+                            help="upload attempts per file")
+    parser.add_argument("--index-cache",
+                            default="/medstore/results/clinical/SARS-CoV-2-typing/hcp_index",
+                            help="directory for the cached HCP object listing")
+    parser.add_argument("--index-ttl", type=int, default=3600,
+                            help="seconds before the cached HCP object listing is refreshed")
+    parser.add_argument("--scan-state",
+                            default="/medstore/results/clinical/SARS-CoV-2-typing/scan_state",
+                            help="directory for the incremental file scan state")
+    args = parser.parse_args(argv)
 
     return args
 
@@ -33,6 +52,10 @@ def arg():
 def setup_logger(name, log_path=None):
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
+    # The watcher runs the pipeline many times in one process, start a new log every run
+    for handle in list(logger.handlers):
+        logger.removeHandler(handle)
+        handle.close()
 
     stream_handle = logging.StreamHandler()
     stream_handle.setLevel(logging.DEBUG)
@@ -49,47 +72,60 @@ def setup_logger(name, log_path=None):
 
 
 # Convert xlsx to csv and fill empty cells with NULL
-@log.log_error("/medstore/logs/pipeline_logfiles/sars-cov-2-typing/direkttestwrapper_cronjob.log")
-def csv_from_excel(xlsx_path):
-    for x in xlsx_path:
-        csv_parse(x)
-
-
-# Upload files to HCP
-def upload_fastq(files_pg, hcpm, logger):
-    for file_pg in files_pg:
-        if hcpm.search_objects(file_pg) is None:
-            try:
-                hcpm.upload_file(file_pg, "covid-wgs/"+os.path.basename(file_pg))
-                logger.info(f"uploading: {file_pg}")
-            except Exception as e:
-                logger.error(e)
-                continue
-        else:
-            logger.error(f"Object already exists {file_pg}")
-            continue
-           
+@log.log_error(ERROR_LOG)
+def csv_from_excel(xlsx_path, cache, jobs, logger):
+    summary = convert_workbooks(xlsx_path, cache, workers=jobs, log_path=ERROR_LOG, logger=logger)
+    if summary["failed"]:
+        # Fail the stage, so the scan state is kept and the workbooks are converted again next run
+        raise IOError(f'xlsx conversion failed for {len(summary["failed"])} files')
+    return list(summary["ok"].values())
 
-def main():
-    args= arg()
+
+# Returns False if a stage failed, None if files are not ready yet
+# hcpm: connected HCPManager to reuse, None connects when the upload starts
+def pipeline(args, hcpm=None):
 
     #Set up the logfile
     now = datetime.datetime.now()
     logfile = os.path.join("/medstore/logs/pipeline_logfiles/sars-cov-2-typing/HCP_upload/", "HCP_upload_direkttest" + now.strftime("%y%m%d_%H%M%S") + ".log")
     logger = setup_logger('hcp_log', logfile)
 
-    # Connect to HCP
-    hcpm = HCPManager(args.endpoint, args.aws_access_key_id, args.aws_secret_access_key)
-    hcpm.attach_bucket(args.bucket)
+    # Find new or changed files since the last successful run
+    scanner = ScanState(os.path.join(args.scan_state, "direkttest.json"))
+    # Workbooks still being saved are left for the next run
+    settled = lambda paths: settled_files(paths, args.settle_age)
+    xlsx_path = take_ready(scanner, scanner.scan("/medstore/results/clinical/SARS-CoV-2-typing/direkttest/direkttest_*.xlsx"), settled, logger)
+
+    def settled_inputs(paths):
+        # The csv of a workbook is written atomically by csv_from_excel, only the other files have to settle
+        ours = [path for path in paths if path.endswith(".csv") and os.path.exists(path[:-len("csv")] + "xlsx")]
+        ready, waiting = settled([path for path in paths if path not in ours])
+        return ours + ready, waiting
+
+    scanned = {}
+
+    def files_pg():
+        # Scanned after the conversion, so the new csv files are included
+        if "hcp" not in scanned:
+            scanned["hcp"] = take_ready(scanner, scanner.scan("/medstore/results/clinical/SARS-CoV-2-typing/direkttest/*"), settled_inputs, logger)
+        return scanned["hcp"]
 
-    # Find files using check_files module
     # Convert xlsx files and upload to HCP
-    xlsx_path = check_files("/medstore/results/clinical/SARS-CoV-2-typing/direkttest/direkttest_*.xlsx")
-    csv_from_excel(xlsx_path)
+    cache = ArtifactCache(os.path.join(args.scan_state, "direkttest_conversions.json"))
+    graph = StageGraph(logger)
+    graph.add("csv_from_excel", lambda: csv_from_excel(xlsx_path, cache, args.jobs, logger),
+              fingerprint=lambda: fingerprint(xlsx_path))
+    # Connects to HCP unless the watcher passed its connected client
+    graph.add("hcp_upload", lambda: upload_stage(args, files_pg(), logger, hcpm),
+              deps=["csv_from_excel"], fingerprint=lambda: fingerprint(files_pg()))
 
-    files_pg = check_files("/medstore/results/clinical/SARS-CoV-2-typing/direkttest/*")
-    upload_fastq(files_pg,hcpm,logger)    
+    return run_pipeline(graph, scanner, args.scan_state, "direkttest", logger, workers=1)
 
 
+def main():
+    args = arg()
+    if pipeline(args) is False:
+        sys.exit(1)
+
 if __name__ == "__main__":
     main()
@@ -2,18 +2,24 @@
 
 import argparse
 import os
-import pandas as pd
-import fnmatch
 import logging
 import datetime
-from NGPinterface.hcp import HCPManager
+import sys
 from tools import log
-from tools.check_files import check_files
+from tools.scan_state import ScanState
+from tools.artifact_cache import ArtifactCache
+from tools.stages import StageGraph
+from tools.run_state import fingerprint
+from tools.readiness import eurofins_ready, take_ready
 from tools.microReport import eurofins as microreport
 from tools.syncsftp import main as syncsftp
 from tools.emailer import email_micro
+from tools.pangolin_outputs import postprocess, EUROFINS
+from tools.hcp_upload import upload_stage, run_pipeline
 
-def arg():
+ERROR_LOG = "/medstore/logs/pipeline_logfiles/sars-cov-2-typing/eurofinswrapper_cronjob.log"
+
+def arg(argv=None):
     parser = argparse.ArgumentParser(prog="direkttest_cronscript.py")
     requiredNamed = parser.add_argument_group('required arguments')
 
@@ -29,7 +35,25 @@ def arg():
                             help="username for eurofins sftp connection")
     requiredNamed.add_argument("-p", "--password",
                             help="password for eurofins sftp connection")
-    args = parser.parse_args()
+    parser.add_argument("--sync-streams", type=int, default=4,
+                            help="number of parallel downloads from the eurofins ftp")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                            help="number of processes for the per-file conversions")
+    parser.add_argument("--stage-workers", type=int, default=4,
+                            help="number of stages run at the same time")
+    parser.add_argument("-w", "--workers", type=int, default=4,
+                            help="number of parallel HCP uploads")
+    parser.add_argument("--retries", type=int, default=3,
+                            help="upload attempts per file")
+    parser.add_argument("--index-cache",
+                            default="/medstore/results/clinical/SARS-CoV-2-typing/hcp_index",
+                            help="directory for the cached HCP object listing")
+    parser.add_argument("--index-ttl", type=int, default=3600,
+                            help="seconds before the cached HCP object listing is refreshed")
+    parser.add_argument("--scan-state",
+                            default="/medstore/results/clinical/SARS-CoV-2-typing/scan_state",
+                            help="directory for the incremental file scan state")
+    args = parser.parse_args(argv)
 
     return args
 
@@ -37,6 +61,10 @@ def arg():
 def setup_logger(name, log_path=None):
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
+    # The watcher runs the pipeline many times in one process, start a new log every run
+    for handle in list(logger.handlers):
+        logger.removeHandler(handle)
+        handle.close()
 
     stream_handle = logging.StreamHandler()
     stream_handle.setLevel(logging.DEBUG)
@@ -52,7 +80,7 @@ def setup_logger(name, log_path=None):
     return logger
 
 
-@log.log_error("/medstore/logs/pipeline_logfiles/sars-cov-2-typing/eurofinswrapper_cronjob.log")
+@log.log_error(ERROR_LOG)
 # Sync eurofins data
 def sync_sftp(args):
     logdir = "/medstore/logs/pipeline_logfiles/sars-cov-2-typing/eurofins-sftp"
@@ -60,20 +88,21 @@ def sync_sftp(args):
     eurofinshost = "ftp.gatc-biotech.com"
     username = args.username
     password = args.password
-    syncsftp(logdir, dataloc, eurofinshost, username, password, no_mail=False, no_sync=False)
+    syncsftp(logdir, dataloc, eurofinshost, username, password, no_mail=False, no_sync=False,
+             streams=args.sync_streams)
 
 
-@log.log_error("/medstore/logs/pipeline_logfiles/sars-cov-2-typing/eurofinswrapper_cronjob.log")
+@log.log_error(ERROR_LOG)
 # Fix pangolin by filling empty fields with NULL
-def pangolin(pangolin_path):
-    for f in pangolin_path:
-        if fnmatch.fnmatch(os.path.basename(f), "*_pangolin_lineage_classification.txt"): 
-            print("updating: " + f)
-            df = pd.DataFrame(pd.read_csv(f, sep="\t")).fillna(value = "NULL")
-            df.to_csv(os.path.abspath(f).replace(".txt","_fillempty.txt"), index=None, header=True, sep="\t") 
+def pangolin(pangolin_path, cache, jobs, logger):
+    summary = postprocess(pangolin_path, EUROFINS, cache, workers=jobs, log_path=ERROR_LOG, logger=logger)
+    if summary["failed"]:
+        # Fail the stage, so the scan state is kept and the reports are converted again next run
+        raise IOError(f'Pangolin conversion failed for {len(summary["failed"])} files')
+    return [out for outputs in summary["ok"].values() for out in outputs]
 
 
-@log.log_error("/medstore/logs/pipeline_logfiles/sars-cov-2-typing/eurofinswrapper_cronjob.log")
+@log.log_error(ERROR_LOG)
 # Sync pangolin files to micro sftp
 def micro_report():
     eurofinsdir = "/medstore/results/clinical/SARS-CoV-2-typing/eurofins_data/goteborg"
@@ -87,49 +116,55 @@ def micro_report():
     email_micro(message_subject, message_body)
 
 # Upload files and json to selected bucket on HCP.
-def upload_fastq(hcp_paths,hcpm,logger):
-    for file_pg in hcp_paths:
-        if "md5sums.txt" in file_pg or file_pg.endswith("classification.txt"):
-            continue
-        else:
-            if hcpm.search_objects(file_pg) is None:
-                try:
-                     hcpm.upload_file(file_pg, "covid-wgs/"+os.path.basename(file_pg))
-                     logger.info(f"uploading: {file_pg}")
-                except Exception as e:
-                    logger.error(e)
-                    continue
-            else:
-                logger.error(f"Object already exists {file_pg}")
-                continue
-    
+def upload_fastq(hcp_paths,hcpm,logger,args):
+    hcp_paths = [f for f in hcp_paths if not ("md5sums.txt" in f or f.endswith("classification.txt"))]
+    upload_stage(args, hcp_paths, logger, hcpm)
 
-def main():
-    args = arg()
+
+# Returns False if a stage failed, None if files are not ready yet
+# hcpm: connected HCPManager to reuse, None connects when the upload starts
+def pipeline(args, hcpm=None):
 
     #Set up the logfile
     now = datetime.datetime.now()
     logfile = os.path.join("/medstore/logs/pipeline_logfiles/sars-cov-2-typing/HCP_upload/", "HCP_upload_eurofins" + now.strftime("%y%m%d_%H%M%S") + ".log")
     logger = setup_logger('hcp_log', logfile)
 
-    # Connect to HCP
-    hcpm = HCPManager(args.endpoint, args.aws_access_key_id, args.aws_secret_access_key)
-    hcpm.attach_bucket(args.bucket)
+    # Only new or changed files since the last successful run
+    scanner = ScanState(os.path.join(args.scan_state, "eurofins.json"))
+    scanned = {}
 
-    # Mirror files from eurofins
-    sync_sftp(args)
-    
-    # Find panoling files and add NULL to empty fields
-    pangolin_path = check_files("/medstore/results/clinical/SARS-CoV-2-typing/eurofins_data/goteborg/2*/*_pangolin_lineage_classification.txt")
-    pangolin(pangolin_path)
+    # Only date directories with a complete md5sums.txt and all files mirrored
+    def pangolin_paths():
+        if "pangolin" not in scanned:
+            scanned["pangolin"] = take_ready(scanner, scanner.scan("/medstore/results/clinical/SARS-CoV-2-typing/eurofins_data/goteborg/2*/*_pangolin_lineage_classification.txt"), eurofins_ready, logger)
+        return scanned["pangolin"]
 
-    # Find pangolin files and sync to micro
-    micro_report()
+    def hcp_paths():
+        if "hcp" not in scanned:
+            scanned["hcp"] = take_ready(scanner, scanner.scan("/medstore/results/clinical/SARS-CoV-2-typing/eurofins_data/goteborg/2021*/*"), eurofins_ready, logger)
+        return scanned["hcp"]
 
+    graph = StageGraph(logger)
+    # Mirror files from eurofins, always run, the stages after it fingerprint what it brought in
+    graph.add("sync_sftp", lambda: sync_sftp(args), volatile=True)
+    # Find panoling files and add NULL to empty fields
+    graph.add("pangolin", lambda: pangolin(pangolin_paths(), ArtifactCache(os.path.join(args.scan_state, "eurofins_conversions.json")), args.jobs, logger),
+              deps=["sync_sftp"], fingerprint=lambda: fingerprint(pangolin_paths()))
+    # Find pangolin files and sync to micro
+    graph.add("micro_report", micro_report, deps=["pangolin"])
     # Find eurofins files and upload to HCP
-    hcp_paths = check_files("/medstore/results/clinical/SARS-CoV-2-typing/eurofins_data/goteborg/2021*/*")
-    upload_fastq(hcp_paths,hcpm,logger)
+    # Connects to HCP unless the watcher passed its connected client
+    graph.add("hcp_upload", lambda: upload_fastq(hcp_paths(), hcpm, logger, args),
+              deps=["pangolin"], fingerprint=lambda: fingerprint(hcp_paths()))
+
+    return run_pipeline(graph, scanner, args.scan_state, "eurofins", logger, workers=args.stage_workers)
 
 
+def main():
+    args = arg()
+    if pipeline(args) is False:
+        sys.exit(1)
+
 if __name__ == "__main__":
     main()
@@ -4,14 +4,13 @@ import click
 import datetime
 import os
 import sys
-import glob
-from sample_sheet import SampleSheet
-from collections import defaultdict
-import pysftp
 import smtplib
 from email.message import EmailMessage
 from shutil import copyfile
 import csv
+from sftp_upload import upload_samples, UploadJournal
+from registry import open_registry, registry_path
+from resolver import resolve, ResolveError
 
 @click.command()
 @click.option('-r', '--runid', required=True,
@@ -37,6 +36,10 @@ import csv
 @click.option('--gensamhost', required=True,
               default='gensam-sftp.folkhalsomyndigheten.se',
               help='FOHM GENSAM hostname')
+@click.option('--gensamport', default=22, type=int,
+              help='FOHM GENSAM sFTP port')
+@click.option('--channels', default=4, type=int,
+              help='Number of parallel sFTP sessions used for the upload')
 @click.option('--sftpusername', required=True,
               default='se300',
               help='Username to the GENSAM sFTP')
@@ -52,13 +55,13 @@ import csv
               help='Manually specify a CSV file to upload to GENSAM with samples and info. Also used to specify which samples to upload')
 @click.option('--uploadedsamples',
               default='/medstore/results/clinical/SARS-CoV-2-typing/nextseq_data/gensam_upload/uploaded2gensam.txt',
-              help='File containing already uploaded samples.')
+              help='File containing already uploaded samples. The indexed registry (.db) next to it is used, the text file is imported the first time.')
 @click.option('--no-mail', is_flag=True,
               help="Set if you do NOT want e-mails to be sent")
 @click.option('--no-upload', is_flag=True,
               help="Set if you do NOT want to upload files to FOHM. Will still try to connect to the sFTP.")
 def main(runid, demultiplexdir, logdir, inputdir, samplesheetname, regioncode, labcode, sshkey, 
-         sshkey_password, gensamhost, sftpusername, gensamcsvdir, manualcsv, uploadedsamples, no_mail, no_upload):
+         sshkey_password, gensamhost, gensamport, channels, sftpusername, gensamcsvdir, manualcsv, uploadedsamples, no_mail, no_upload):
 
     #Run checks on all given inputs
     checkinput(runid, demultiplexdir, inputdir, regioncode, labcode, logdir, 
@@ -80,55 +83,34 @@ def main(runid, demultiplexdir, logdir, inputdir, samplesheetname, regioncode, l
     #Read in all sampleIDs
     samples = sample_sheet(sspath)
 
-    #Get a list of all fastq and fasta files to upload
-    syncdict = defaultdict(lambda: defaultdict(dict))
+    #Get all fastq and fasta files to upload, one scan of each directory
     log.write(writelog("LOG", "Finding all files to upload."))
-    
-    for sample in samples:
-        #Find all fastq files to upload.
-        fastqpath = os.path.join(inputdir, runid, 'fastq')
-        for fastqfile in glob.glob(fastqpath + "/" + sample + "*fastq.gz"):
-            targetlink = os.readlink(fastqfile)
-            if targetlink.endswith("R1_001.fastq.gz"): #Fastq files need to have this extension right now. It's ugly
-                syncdict[sample]['fastq']['R1'] = targetlink
-            elif targetlink.endswith("R2_001.fastq.gz"):
-                syncdict[sample]['fastq']['R2'] = targetlink
-            else:
-                log.write(writelog("ERROR", "Found fastq file with ending other than R1(R2)_001.fastq.gz"))
-                if not no_mail:
-                    email_error(logfile, "FASTQ UPLOAD")
-                sys.exit("ERROR: Found fastq file with ending other than R1(R2)_001.fastq.gz")
-        
-        #Find all fasta files to upload based on existing links.
-        fastapath = os.path.join(inputdir, runid, 'fasta')
-        for fastafile in glob.glob(fastapath + "/" + sample + "*consensus.fa"):
-            targetlink = os.readlink(fastafile)
-            #Store info in dict
-            syncdict[sample]['fasta'] = targetlink
+    try:
+        syncdict = resolve(inputdir, runid, samples)
+    except ResolveError as e:
+        log.write(writelog("ERROR", str(e)))
+        if not no_mail:
+            email_error(logfile, "FASTQ UPLOAD")
+        sys.exit("ERROR: " + str(e))
 
     #Check that all fastq files are paired
-    #This code feels a bit clunky
-    for sample in syncdict:
-        if syncdict[sample]['fastq']['R1']:
-            if not syncdict[sample]['fastq']['R2']:
-                log.write(writelog("ERROR", "No R2 file found for " + syncdict[sample]['fastq']['R1'] + "."))
-                if not no_mail:
-                    email_error(logfile, "FASTQ PAIRING")
-                sys.exit("ERROR: No R2 file found for " + syncdict[sample]['fastq']['R1'] + ".")
-        if syncdict[sample]['fastq']['R2']:
-            if not syncdict[sample]['fastq']['R1']:
-                log.write(writelog("ERROR", "No R1 file found for " + syncdict[sample]['fastq']['R2'] + "."))
-                if not no_mail:
-                    email_error(logfile, "FASTQ PAIRING")
-                sys.exit("ERROR: No R1 file found for " + syncdict[sample]['fastq']['R2'] + ".")
+    for sample in syncdict.values():
+        if sample.r1 and not sample.r2:
+            log.write(writelog("ERROR", "No R2 file found for " + sample.r1 + "."))
+            if not no_mail:
+                email_error(logfile, "FASTQ PAIRING")
+            sys.exit("ERROR: No R2 file found for " + sample.r1 + ".")
+        if sample.r2 and not sample.r1:
+            log.write(writelog("ERROR", "No R1 file found for " + sample.r2 + "."))
+            if not no_mail:
+                email_error(logfile, "FASTQ PAIRING")
+            sys.exit("ERROR: No R1 file found for " + sample.r2 + ".")
 
     #Check how manny files there is to upload
-    for filetype in ['fastq', 'fasta']:
-        numfiles = countkeys(syncdict, filetype)
-        if filetype == 'fastq':
-            log.write(writelog("LOG", "Found " + str(numfiles) + " " + filetype  + " pairs to upload."))
-        else:
-            log.write(writelog("LOG", "Found " + str(numfiles) + " " + filetype  + " files to upload."))
+    numfastq = sum(1 for sample in syncdict.values() if sample.r1)
+    numfasta = sum(1 for sample in syncdict.values() if sample.fasta)
+    log.write(writelog("LOG", "Found " + str(numfastq) + " fastq pairs to upload."))
+    log.write(writelog("LOG", "Found " + str(numfasta) + " fasta files to upload."))
 
     #Make an csv file with FOHM info
     #Also store all samples from this file in a list
@@ -176,9 +158,17 @@ def main(runid, demultiplexdir, logdir, inputdir, samplesheetname, regioncode, l
     else:
         log.write(writelog("LOG", "Starting sFTP upload."))
 
-    try:
-        sftp = pysftp.Connection(gensamhost, username=sftpusername, private_key=sshkey, private_key_pass=sshkey_password, log=logfile_sftp)
+    import pysftp
+
+    def connect():
+        sftp = pysftp.Connection(gensamhost, port=gensamport, username=sftpusername, private_key=sshkey,
+                                 private_key_pass=sshkey_password, log=logfile_sftp)
         sftp.chdir("till-fohm")
+        return sftp
+
+    #Test the connection, the uploads open their own sessions
+    try:
+        connect().close()
     except:
         log.write(writelog("ERROR", "Establishing sFTP connection failed. Check the sFTP log @ " + logfile_sftp))
         if not no_mail:
@@ -186,18 +176,11 @@ def main(runid, demultiplexdir, logdir, inputdir, samplesheetname, regioncode, l
         sys.exit("ERROR: Establishing sFTP connection failed. Check the sFTP log @ " + logfile_sftp)
 
     #Upload all files to the FOHM FTP
-    #Read in all files previously uploaded. Perhaps there is a faster, indexwed way?
-    uploads_dict = {}
-    with open(uploadedsamples) as csv_file:
-            csv_reader = csv.reader(csv_file, delimiter=',')
-            for row in csv_reader:
-            #add sample names to dict
-                uploads_dict[row[0]] = ''
-
-    #Open file with previously uploaded files for writing
-    uploads_samples = open(uploadedsamples, "a")
+    #Registry of previously uploaded samples
+    registry = open_registry(uploadedsamples)
 
     #fastq and fasta file
+    jobs = []
     for sample in syncdict:
         #Skip sample if not in the gensamcsv file. Only really matters if there is a manually supplied csv file
         if not sample in gensamcsv_samples:
@@ -205,52 +188,70 @@ def main(runid, demultiplexdir, logdir, inputdir, samplesheetname, regioncode, l
             continue
 
         #Is sample already uploaded (and no-upload flag not set)? If so, skip
-        if sample in uploads_dict:
-            log.write(writelog("WARNING", f'Sample {sample} found in file of previously uploaded samples @ {uploadedsamples}. Skipping it.'))
+        if sample in registry:
+            log.write(writelog("WARNING", f'Sample {sample} found in registry of previously uploaded samples @ {registry.path}. Skipping it.'))
             continue
 
+        files = []
         #Get all fastq files and construct correct names
-        if syncdict[sample]['fastq']['R1']: #Check if sample has fastq files to upload
-            fastqR1_src = syncdict[sample]['fastq']['R1']
-            fastqR2_src = syncdict[sample]['fastq']['R2']
+        if syncdict[sample].r1: #Check if sample has fastq files to upload
+            fastqR1_src = syncdict[sample].r1
+            fastqR2_src = syncdict[sample].r2
 
             samplename_R1 = sample.replace("_", "-") + '_1.fastq.gz'
             fastqR1_trgt = '_'.join((regioncode, labcode, samplename_R1))
             samplename_R2 = sample.replace("_", "-") + '_2.fastq.gz'
             fastqR2_trgt = '_'.join((regioncode, labcode, samplename_R2))
-            #Upload to sFTP
-            if not no_upload:
-                sftp.put(fastqR1_src, fastqR1_trgt)
-                sftp.put(fastqR2_src, fastqR2_trgt)
+            files.append((fastqR1_src, fastqR1_trgt))
+            files.append((fastqR2_src, fastqR2_trgt))
                                 
         # Get all fasta files and construct correct names
-        if syncdict[sample]['fasta']: #Check if sample has fastq files to upload
-            fasta_src = syncdict[sample]['fasta']
+        if syncdict[sample].fasta: #Check if sample has fasta files to upload
+            fasta_src = syncdict[sample].fasta
             samplename_fasta = sample.replace("_", "-") + '.consensus.fasta'
             fasta_trgt = '_'.join((regioncode, labcode, samplename_fasta))
-            #Upload to sFTP
-            if not no_upload:
-                sftp.put(fasta_src, fasta_trgt)
+            files.append((fasta_src, fasta_trgt))
 
-        #Save sample name in uploaded samples file unless
-        if not no_upload:
-            uploads_samples.write(f'{sample}\n')
+        jobs.append((sample, files))
 
+    #Upload the samples over several sFTP sessions.
+    #Save sample in the registry once all its files are confirmed on the sFTP
+    def sample_done(sample, files):
+        registry.add(sample, runid, files, "gensamupload")
 
-    #Pangolin classification lineage file    
-    lineagepath = os.path.join(inputdir, runid, 'lineage', runid + "_lineage_report_gensam.txt")
-    lineage_trgt = '_'.join((regioncode, labcode, date_simple, "pangolin_classification.txt"))
+    failed = {}
     if not no_upload:
-        sftp.put(lineagepath, lineage_trgt)
-
-    #Close the uploaded samples file
-    uploads_samples.close()
-
-    #Close the sFTP connection
-    sftp.close()
+        log.write(writelog("LOG", f'Uploading {len(jobs)} samples using {channels} sFTP sessions.'))
+        #Per file checkpoints, lets a rerun skip finished files and resume partial ones
+        journal = UploadJournal(os.path.join(os.path.dirname(uploadedsamples), "gensam_upload_journal.jsonl"))
+        summary = upload_samples(connect, jobs, sample_done, channels, journal)
+        failed = summary["failed"]
+        for sample, error in failed.items():
+            log.write(writelog("ERROR", f'Upload of sample {sample} failed: {error}'))
+        log.write(writelog("LOG", f'Uploaded {len(summary["uploaded"])} samples, {len(failed)} failed.'))
+
+        #Pangolin classification lineage file, on a new session and checkpointed like the samples
+        lineagepath = os.path.join(inputdir, runid, 'lineage', runid + "_lineage_report_gensam.txt")
+        lineage_trgt = '_'.join((regioncode, labcode, date_simple, "pangolin_classification.txt"))
+        lineage = upload_samples(connect, [(lineage_trgt, [(lineagepath, lineage_trgt)])],
+                                 lambda name, files: None, 1, journal)
+        for name, error in lineage["failed"].items():
+            log.write(writelog("ERROR", f'Upload of {name} failed: {error}'))
+        failed.update(lineage["failed"])
+
+        if failed and not no_mail:
+            email_error(logfile, "sFTP UPLOAD")
+
+    #Close the registry
+    registry.close()
 
     if no_upload:
         log.write(writelog("LOG", "Completed test of sFTP connection."))
+    elif failed:
+        #Don't tell FOHM about an incomplete upload, the rerun resumes the failed samples
+        log.write(writelog("ERROR", f'sFTP upload incomplete, {len(failed)} uploads failed. Skipping mail to FOHM'))
+        log.close()
+        sys.exit("ERROR: Upload failed for " + ", ".join(sorted(failed)) + ". Check the log @ " + logfile)
     else:
         log.write(writelog("LOG", "Finished the sFTP upload."))
 
@@ -279,7 +280,7 @@ def checkinput(runid, demultiplexdir, inputdir, regioncode, labcode, logdir,
         sys.exit("ERROR: The specified manual GENSAM CSV file does not seem to exist @ " +  os.path.abspath(manualcsv))
 
     #Check file containing previously uploaded samples.
-    if not os.path.isfile(uploadedsamples):
+    if not os.path.isfile(uploadedsamples) and not os.path.isfile(registry_path(uploadedsamples)):
         sys.exit("ERROR: Can't find file containing previously not uploaded sample @ " +  uploadedsamples)
 
     #Check for all fasta, fastq and lineage directories are in place
@@ -318,6 +319,7 @@ def checkinput(runid, demultiplexdir, inputdir, regioncode, labcode, logdir,
  
 
 def sample_sheet(sspath):
+    from sample_sheet import SampleSheet
     Sheet = SampleSheet(sspath)
     data = []
     for sample in Sheet.samples:
@@ -343,13 +345,6 @@ def writelog(logtype, message):
     logstring = "[" + now.strftime("%Y-%m-%d %H:%M:%S") + "] - " + logtype + " - " + message + "\n"
     return logstring
 
-def countkeys(dictname, group):
-    count = 0
-    for keys in dictname:
-        if dictname[keys][group]:
-            count += 1
-    return count
-
 def email_error(logloc, errorstep):
     msg = EmailMessage()
     msg.set_content("Errors were encountered during the automatic upload of samples to FOHM GENSAM.\n\n" +
@@ -11,7 +11,8 @@ from email.message import EmailMessage
 import logging
 from collections import defaultdict
 import csv
-import pysftp
+from registry import SampleRegistry, DEFAULT_DB
+from tools.hashing import file_digest
 
 @click.command()
 @click.option('-d', '--datadir', required=True,
@@ -43,12 +44,14 @@ import pysftp
 @click.option('-m', '--max-age', required=True, type=int,
               default=15,
               help='Max age of files to keep in sent-files folder')
+@click.option('--registry', default=DEFAULT_DB,
+              help='Registry of samples uploaded to GENSAM, shared with gensamupload.py')
 @click.option('--no-mail', is_flag=True,
               help="Set if you do NOT want e-mails to be sent")
 @click.option('--no-upload', is_flag=True,
               help="Set if you do NOT want to upload files to FOHM. Will still try to connect to the sFTP.")
 def main (datadir, logdir, sent_files, regioncode, labcode, gensamhost, 
-          sftpusername, sshkey, sshkey_password, max_age, no_mail, no_upload):
+          sftpusername, sshkey, sshkey_password, max_age, registry, no_mail, no_upload):
 
     #Run checks on all given inputs
     checkinput(datadir, logdir, sent_files, regioncode, labcode)
@@ -89,6 +92,7 @@ def main (datadir, logdir, sent_files, regioncode, labcode, gensamhost,
         
     #Open the sFTP connection
     logger.info("Establishing sFTP connection to GENSAM")
+    import pysftp
     try:
         sftp = pysftp.Connection(gensamhost, username=sftpusername, private_key=sshkey, private_key_pass=sshkey_password, log=logfile_sftp)
         sftp.chdir("till-fohm")
@@ -111,6 +115,10 @@ def main (datadir, logdir, sent_files, regioncode, labcode, gensamhost,
             for datafile in syncfiles[datatype]:
                 sftp.put(datafile)
 
+        #Record the uploaded samples in the registry
+        register_samples(registry, syncfiles, regioncode, labcode, "micro_" + now.strftime("%y%m%d_%H%M%S"))
+        logger.info(f'Recorded uploaded samples in {registry}.')
+
     #Send e-mails to FOHM and KMIK (and clinicalgenomics)
     if no_mail:
         logger.info("No-mail flag set. Skipping sending e-mails")
@@ -148,6 +156,27 @@ def main (datadir, logdir, sent_files, regioncode, labcode, gensamhost,
     #All done!
     logger.info("Microbiology GENSAM-upload workflow completed")
 
+# Sample name from the file name, e.g. 14_SE300_<sample>_1.fastq.gz
+def sample_name(datafile, regioncode, labcode):
+    name = os.path.basename(datafile)[len(f'{regioncode}_{labcode}_'):]
+    for suffix in ('.consensus.fasta', '_1.fastq.gz', '_2.fastq.gz', '.fastq.gz', '.vcf'):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def register_samples(registry, syncfiles, regioncode, labcode, runid):
+    samples = defaultdict(dict)
+    for datatype in ('fasta', 'fastq', 'variants'):
+        for datafile in syncfiles[datatype]:
+            samples[sample_name(datafile, regioncode, labcode)][os.path.basename(datafile)] = file_digest(datafile)
+
+    db = SampleRegistry(registry)
+    for sample, files in samples.items():
+        db.add(sample, runid, files, "micro_gensamupload")
+    db.close()
+
+
 def find_old(sent_files, max_age, now):
     old_files = []
     ago = now-datetime.timedelta(days=max_age)
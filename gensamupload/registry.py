@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+# Registry of samples uploaded to GENSAM, replaces uploaded2gensam.txt.
+# SQLite keyed by sample, with the run ID, the sha256 of every uploaded
+# file and the upload time. WAL mode and a lock timeout let
+# gensamupload.py and micro_gensamupload.py share it.
+# The old text file next to the registry is imported the first time either
+# script opens it, the import is recorded in the meta table.
+# Samples are keyed by the name used on the GENSAM sFTP ("_" replaced by
+# "-"), gensamupload.py knows the original sample names and
+# micro_gensamupload.py only the uploaded file names. A sample uploaded by
+# both keeps the first run ID and upload time, the files and sources of both.
+#
+# The scripts in gensamupload/ import from tools/, run them with the
+# repository root on PYTHONPATH:
+#   PYTHONPATH=. gensamupload/registry.py -d uploaded2gensam.db import uploaded2gensam.txt
+#   PYTHONPATH=. gensamupload/registry.py -d uploaded2gensam.db sample <sample>
+#   PYTHONPATH=. gensamupload/registry.py -d uploaded2gensam.db run <runid>
+
+import click
+import datetime
+import json
+import os
+import sqlite3
+from tools.hashing import file_digest
+
+DEFAULT_DB = '/medstore/results/clinical/SARS-CoV-2-typing/nextseq_data/gensam_upload/uploaded2gensam.db'
+FIELDS = ("sample", "runid", "files", "uploaded_at", "source")
+
+
+# Registry next to the old text file, e.g. uploaded2gensam.txt -> uploaded2gensam.db
+def registry_path(uploadedsamples):
+    return os.path.splitext(uploadedsamples)[0] + ".db"
+
+
+# Registry key of a sample, the name used in the GENSAM file names
+def sample_key(sample):
+    return sample.replace("_", "-")
+
+
+class SampleRegistry:
+    # legacy: old text file to import once, default uploaded2gensam.txt next to the registry
+    def __init__(self, path, timeout=60, legacy=None):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS uploads ("
+                          "sample TEXT PRIMARY KEY, runid TEXT, files TEXT, uploaded_at TEXT, source TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS uploads_runid ON uploads (runid)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+        if self.meta("keys_normalised") is None:
+            # Registries written before the keys were normalised
+            rows = self.conn.execute(f"SELECT {', '.join(FIELDS)} FROM uploads WHERE sample != replace(sample, '_', '-')")
+            for record in [self._record(row) for row in rows]:
+                self.conn.execute("DELETE FROM uploads WHERE sample = ?", (record["sample"],))
+                self._merge(record["sample"], record["runid"], record["files"], record["uploaded_at"], record["source"])
+            self.set_meta("keys_normalised", "1")
+
+        legacy = legacy or os.path.splitext(path)[0] + ".txt"
+        if os.path.exists(legacy) and self.meta("legacy_imported") is None:
+            # Importing twice is harmless, samples already in the registry are kept
+            self.import_text(legacy)
+            self.set_meta("legacy_imported", legacy)
+
+    def meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def __contains__(self, sample):
+        return self.conn.execute("SELECT 1 FROM uploads WHERE sample = ?", (sample_key(sample),)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM uploads").fetchone()[0]
+
+    def _record(self, row):
+        record = dict(zip(FIELDS, row))
+        record["files"] = json.loads(record["files"]) if record["files"] else {}
+        return record
+
+    def get(self, sample):
+        row = self.conn.execute(f"SELECT {', '.join(FIELDS)} FROM uploads WHERE sample = ?", (sample_key(sample),)).fetchone()
+        return self._record(row) if row else None
+
+    def by_run(self, runid):
+        rows = self.conn.execute(f"SELECT {', '.join(FIELDS)} FROM uploads WHERE runid = ? ORDER BY sample", (runid,))
+        return [self._record(row) for row in rows]
+
+    # files: {remote name: sha256}
+    def add(self, sample, runid, files, source):
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self._merge(sample, runid, files, now, source)
+
+    # Insert a record, or merge it into the record of the sample without
+    # overwriting what another source recorded
+    def _merge(self, sample, runid, files, uploaded_at, source):
+        sample = sample_key(sample)
+        # Read and write in one transaction, the other script may add the same sample
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            old = self.get(sample)
+            if old:
+                files = dict(old["files"], **files)
+                runid = old["runid"] or runid
+                uploaded_at = old["uploaded_at"] or uploaded_at
+                sources = set(filter(None, (old["source"] or "").split(","))) | {source}
+                source = ",".join(sorted(sources))
+            self.conn.execute("INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?)",
+                              (sample, runid, json.dumps(files), uploaded_at, source))
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    # Samples from the old uploaded2gensam.txt, without run ID or digests
+    def import_text(self, uploadedsamples):
+        with open(uploadedsamples) as f:
+            samples = [(sample_key(line.split(",")[0].strip()), "legacy") for line in f if line.strip()]
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO uploads (sample, source) VALUES (?, ?)", samples)
+        return len(samples)
+
+    def close(self):
+        self.conn.close()
+
+
+# Open the registry for an uploaded2gensam.txt path, importing the text file the first time
+def open_registry(uploadedsamples):
+    return SampleRegistry(registry_path(uploadedsamples), legacy=uploadedsamples)
+
+
+def show(record):
+    click.echo(f'{record["sample"]}\t{record["runid"] or "-"}\t{record["uploaded_at"] or "-"}\t{record["source"] or "-"}')
+    for name, digest in sorted(record["files"].items()):
+        click.echo(f'\t{name}\t{digest}')
+
+
+@click.group()
+@click.option('-d', '--database', default=DEFAULT_DB,
+              help='Path to the registry')
+@click.pass_context
+def cli(ctx, database):
+    ctx.obj = SampleRegistry(database)
+
+
+@cli.command(name='import')
+@click.argument('textfile')
+@click.pass_obj
+def import_cmd(registry, textfile):
+    """Import samples from an old uploaded2gensam.txt"""
+    count = registry.import_text(textfile)
+    click.echo(f'Imported {count} samples, {len(registry)} samples in {registry.path}')
+
+
+@cli.command()
+@click.argument('sample')
+@click.pass_obj
+def sample(registry, sample):
+    """Show when and in which run a sample was uploaded"""
+    record = registry.get(sample)
+    if record is None:
+        raise click.ClickException(f'{sample} has not been uploaded')
+    show(record)
+
+
+@cli.command()
+@click.argument('runid')
+@click.pass_obj
+def run(registry, runid):
+    """List the samples uploaded in a run"""
+    for record in registry.by_run(runid):
+        show(record)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+# Resolve the fastq and fasta files of each sample in a run.
+# fastq/ and fasta/ are each scanned once. A file belongs to the sample
+# whose name is the longest prefix of the file name followed by "_" or ".",
+# so S1 never picks up the files of S10.
+
+import os
+from typing import Dict, List, Optional
+
+
+class SampleFiles:
+    __slots__ = ("sample", "r1", "r2", "fasta")
+
+    def __init__(self, sample: str, r1: Optional[str] = None, r2: Optional[str] = None, fasta: Optional[str] = None):
+        self.sample = sample
+        self.r1 = r1
+        self.r2 = r2
+        self.fasta = fasta
+
+    def __repr__(self):
+        return f'SampleFiles({self.sample!r}, r1={self.r1!r}, r2={self.r2!r}, fasta={self.fasta!r})'
+
+
+class ResolveError(Exception):
+    pass
+
+
+def match_sample(name: str, samples: set) -> Optional[str]:
+    match = None
+    for i, char in enumerate(name):
+        if char in "_." and name[:i] in samples:
+            match = name[:i]
+    return match
+
+
+# Link target of the file, the files in fastq/ and fasta/ are links to the real data
+def target(entry) -> str:
+    return os.readlink(entry.path) if entry.is_symlink() else entry.path
+
+
+def resolve(inputdir: str, runid: str, samples: List[str]) -> Dict[str, SampleFiles]:
+    wanted = set(samples)
+    manifest = {}
+
+    with os.scandir(os.path.join(inputdir, runid, 'fastq')) as it:
+        for entry in it:
+            if not entry.name.endswith("fastq.gz"):
+                continue
+            sample = match_sample(entry.name, wanted)
+            if sample is None:
+                continue
+            files = manifest.setdefault(sample, SampleFiles(sample))
+            targetlink = target(entry)
+            if targetlink.endswith("R1_001.fastq.gz"): #Fastq files need to have this extension right now
+                read = "r1"
+            elif targetlink.endswith("R2_001.fastq.gz"):
+                read = "r2"
+            else:
+                raise ResolveError(f'Found fastq file with ending other than R1(R2)_001.fastq.gz: {entry.name}')
+            if getattr(files, read) is not None:
+                raise ResolveError(f'Found more than one {read.upper()} fastq file for {sample}')
+            setattr(files, read, targetlink)
+
+    with os.scandir(os.path.join(inputdir, runid, 'fasta')) as it:
+        for entry in it:
+            if not entry.name.endswith("consensus.fa"):
+                continue
+            sample = match_sample(entry.name, wanted)
+            if sample is None:
+                continue
+            files = manifest.setdefault(sample, SampleFiles(sample))
+            if files.fasta is not None:
+                raise ResolveError(f'Found more than one consensus fasta file for {sample}')
+            files.fasta = target(entry)
+
+    # Keep the sample sheet order
+    return {sample: manifest[sample] for sample in samples if sample in manifest}
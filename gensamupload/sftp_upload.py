@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+# Parallel upload of samples to the GENSAM sFTP.
+# Samples are spread over a bounded pool of sFTP sessions, one per thread.
+# A sample is only reported as done when all of its files are on the
+# server with the same size as the local file.
+# Every file transfer is checkpointed in a journal. On a rerun a file that
+# is already complete on the server is skipped and a partly transferred
+# file is resumed from the remote size instead of being sent again.
+
+import datetime
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tools.hashing import file_digest
+
+CHUNK = 1024 * 1024
+
+
+# Append-only journal (JSON lines) of file transfers, last record per remote file wins
+class UploadJournal:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.records[record["remote"]] = record
+
+    def get(self, remote):
+        return self.records.get(remote)
+
+    def write(self, remote, src, state):
+        st = os.stat(src)
+        record = {"remote": remote, "src": os.path.abspath(src), "size": st.st_size, "mtime": st.st_mtime,
+                  "state": state, "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+            self.records[remote] = record
+
+
+def remote_size(sftp, trgt):
+    try:
+        return sftp.stat(trgt).st_size
+    except IOError:
+        return None
+
+
+# Put one file, skipping it if it is already complete on the server and
+# resuming a partial file that this journal started from the same source.
+# Returns "skipped", "resumed" or "uploaded".
+def put_file(sftp, src, trgt, journal=None):
+    st = os.stat(src)
+    size = remote_size(sftp, trgt)
+    record = journal.get(trgt) if journal else None
+    same_src = (record is not None and record["src"] == os.path.abspath(src)
+                and record["size"] == st.st_size and record["mtime"] == st.st_mtime)
+
+    if size == st.st_size:
+        if journal and not (same_src and record["state"] == "done"):
+            journal.write(trgt, src, "done")
+        return "skipped"
+
+    if journal:
+        journal.write(trgt, src, "started")
+
+    if size and size < st.st_size and same_src:
+        with open(src, "rb") as fsrc, sftp.open(trgt, "r+b") as fdst:
+            fdst.set_pipelined(True)
+            fsrc.seek(size)
+            fdst.seek(size)
+            for data in iter(lambda: fsrc.read(CHUNK), b""):
+                fdst.write(data)
+        result = "resumed"
+    else:
+        sftp.put(src, trgt)
+        result = "uploaded"
+
+    size = remote_size(sftp, trgt)
+    if size != st.st_size:
+        raise IOError(f'{trgt} is {size} bytes on the sFTP, expected {st.st_size}')
+    if journal:
+        journal.write(trgt, src, "done")
+    return result
+
+
+# connect: function returning a pysftp.Connection in the upload directory
+# jobs: list of (sample, [(local file, remote name), ...])
+# on_done: called with the sample name and {remote name: sha256}, in the calling thread,
+#          once all its files are confirmed
+# journal: UploadJournal for skipping and resuming files, None always sends whole files
+def upload_samples(connect, jobs, on_done, channels=4, journal=None):
+    local_state = threading.local()
+    connections = []
+    lock = threading.Lock()
+    summary = {"uploaded": [], "failed": {}}
+
+    def upload(sample, files):
+        if getattr(local_state, "sftp", None) is None:
+            local_state.sftp = connect()
+            with lock:
+                connections.append(local_state.sftp)
+        sftp = local_state.sftp
+        try:
+            digests = {}
+            for src, trgt in files:
+                put_file(sftp, src, trgt, journal)
+                digests[trgt] = file_digest(src)
+            return digests
+        except Exception:
+            # Start a new session for the next sample
+            local_state.sftp = None
+            raise
+
+    with ThreadPoolExecutor(max_workers=max(1, channels)) as executor:
+        futures = {executor.submit(upload, sample, files): sample for sample, files in jobs}
+        for future in as_completed(futures):
+            sample = futures[future]
+            try:
+                on_done(sample, future.result())
+                summary["uploaded"].append(sample)
+            except Exception as e:
+                summary["failed"][sample] = e
+
+    for sftp in connections:
+        try:
+            sftp.close()
+        except Exception:
+            pass
+
+    return summary
@@ -9,44 +9,40 @@ import argparse
 import os
 import json
 import sys
-from NGPinterface.hcp import HCPManager
-import datetime as dt
+import logging
+from tools.scan_state import ScanState
+from tools.hcp_upload import upload_files
+from tools.hcp_multipart import multipart_upload, MB
+from tools.hcp_download import download_objects
 
 ##############################################
-# Check files automatic (eurofins)
-def check_files(args):
-    now = dt.datetime.now()
-    ago = now-dt.timedelta(minutes=1440)
-
-    if args.eurofins:
-        path_list = []
-        for path in glob.glob('/medstore/results/clinical/SARS-CoV-2-typing/eurofins_data/goteborg/2021*/*', recursive=True):
-            st = os.stat(path)
-            mtime = dt.datetime.fromtimestamp(st.st_ctime)
-            if mtime > ago:
-                #print('%s modified %s'%(path, mtime))
-                path_list.append(path)
-        return path_list
-
-    if args.direkttest:
-        path_list = []
-        for path in glob.glob('/medstore/results/clinical/SARS-CoV-2-typing/direkttest/*', recursive=True):
-            st = os.stat(path)
-            mtime = dt.datetime.fromtimestamp(st.st_ctime)
-            if mtime > ago:
-                #print('%s modified %s'%(path, mtime))
-                path_list.append(path)
-        return path_list
-
-    if args.nextseq:
-        path_list = []
-        for path in glob.glob('/medstore/results/clinical/SARS-CoV-2-typing/nextseq_data/*/*/*', recursive=True):
-            st = os.stat(path)
-            mtime = dt.datetime.fromtimestamp(st.st_ctime)
-            if mtime > ago:
-                #print('%s modified %s'%(path, mtime))
-                path_list.append(path)
-        return path_list
+# Automatic check for new or changed files (eurofins, direkttest, nextseq)
+PATTERNS = {
+    "eurofins": '/medstore/results/clinical/SARS-CoV-2-typing/eurofins_data/goteborg/2021*/*',
+    "direkttest": '/medstore/results/clinical/SARS-CoV-2-typing/direkttest/*',
+    "nextseq": '/medstore/results/clinical/SARS-CoV-2-typing/nextseq_data/*/*/*',
+}
+
+
+def check_files(args, scanner):
+    for name, pattern in PATTERNS.items():
+        if getattr(args, name):
+            return scanner.scan(pattern, first_window=1440)
+
+
+def setup_logger(name):
+    logger = logging.getLogger(name)
+    if logger.handlers:
+        return logger
+    logger.setLevel(logging.DEBUG)
+
+    stream_handle = logging.StreamHandler()
+    stream_handle.setLevel(logging.DEBUG)
+    stream_handle.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logger.addHandler(stream_handle)
+
+    return logger
+
 
 # List files that will be uploaded on the HCP.
 def files(args):
@@ -57,21 +53,35 @@ def files(args):
 # Upload files and json to selected bucket on HCP.
 def upload_fastq(args, files_pg, hcpm):
     # List and upload files provided by path flag.
-    if args.path or args.eurofins or args.direkttest:
-        for file_pg in files_pg:
-            if "md5sums.txt" in file_pg or file_pg.endswith("classification.txt"):
-                continue
-            else:
-                try:
-                    hcpm.upload_file(file_pg, "covid-wgs/"+os.path.basename(file_pg))
-                    print(f"uploading: {file_pg}")
-                except:
-                    continue
+    logger = setup_logger("hcp_covid")
+    upload = large_object_upload(args, logger) if args.multipart else None
+
+    if args.path or args.eurofins or args.direkttest or args.nextseq:
+        files_pg = [f for f in files_pg if not ("md5sums.txt" in f or f.endswith("classification.txt"))]
+        return upload_files(hcpm, files_pg, logger, workers=args.workers,
+                            retries=args.retries, upload=upload)
 
     if args.filepath:
         # Uploads single file.
-        hcpm.upload_file(f"{args.filepath}",
-                            "covid-wgs/"+os.path.basename(args.filepath))
+        if upload:
+            upload(hcpm, args.filepath, "covid-wgs/"+os.path.basename(args.filepath))
+        else:
+            hcpm.upload_file(f"{args.filepath}",
+                                "covid-wgs/"+os.path.basename(args.filepath))
+
+
+# Files above the chunk size are sent as resumable multipart uploads
+def large_object_upload(args, logger):
+    chunk_size = args.chunk_size * MB
+
+    def upload(hcpm, path, key):
+        if os.path.getsize(path) > chunk_size:
+            multipart_upload(hcpm, path, key, args.state_dir, chunk_size=chunk_size,
+                             workers=args.part_workers, logger=logger)
+        else:
+            hcpm.upload_file(path, key)
+
+    return upload
 
 
 def search(args,hcpm):
@@ -84,16 +94,16 @@ def search(args,hcpm):
 
 
 def download_fastq(args,hcpm,file_lst):
+    logger = setup_logger("hcp_covid")
     if args.key and args.download:
         # Downloads file.
-        obj = hcpm.get_object(f"{args.key}")
-        hcpm.download_file(obj, f"{args.output}/"+os.path.basename(args.key))
+        download_objects(hcpm, [args.key], args.output, logger,
+                         part_workers=args.part_workers, chunk_size=args.chunk_size * MB)
 
     if args.query and args.download:
-        # Downloads several files specified by query.
-        for i in file_lst:
-            obj = hcpm.get_object(i.key)
-            hcpm.download_file(obj, f"{args.output}/"+os.path.basename(i.key))
+        # Downloads several files specified by query, skips files already downloaded.
+        download_objects(hcpm, [i.key for i in file_lst], args.output, logger, workers=args.workers,
+                         part_workers=args.part_workers, chunk_size=args.chunk_size * MB)
 
 
 def listfiles(hcpm):
@@ -141,6 +151,22 @@ def arg():
     parser.add_argument("-n", "--nextseq", 
                             action="store_true", 
                             help="check for nextseq files automatically")
+    parser.add_argument("-w", "--workers", type=int, default=4,
+                            help="number of parallel uploads or downloads")
+    parser.add_argument("--retries", type=int, default=3,
+                            help="upload attempts per file")
+    parser.add_argument("-m", "--multipart",
+                            action="store_true",
+                            help="resumable multipart upload of files larger than --chunk-size")
+    parser.add_argument("--chunk-size", type=int, default=64,
+                            help="multipart part size and download range size in MB")
+    parser.add_argument("--part-workers", type=int, default=4,
+                            help="number of parts uploaded or downloaded in parallel per file")
+    parser.add_argument("--scan-state",
+                            default="/medstore/results/clinical/SARS-CoV-2-typing/scan_state",
+                            help="directory for the incremental file scan state of -e, -i and -n")
+    parser.add_argument("--state-dir", default=os.path.expanduser("~/.hcp_covid/multipart"),
+                            help="directory for multipart upload state, used to resume interrupted uploads")
     args = parser.parse_args()
 
     return args
@@ -149,13 +175,18 @@ def arg():
 def main():
     args = arg()
 
-    # Connect to HCP
+    # Connect to HCP, boto3 is imported here so --help and argument errors are instant
+    from NGPinterface.hcp import HCPManager
     hcpm = HCPManager(args.endpoint, args.aws_access_key_id, args.aws_secret_access_key)
     hcpm.attach_bucket(args.bucket)
 
     if args.eurofins or args.direkttest or args.nextseq:
-        files_pg = check_files(args)
-        upload_fastq(args, files_pg, hcpm)
+        scanner = ScanState(os.path.join(args.scan_state, "hcp_covid.json"))
+        files_pg = check_files(args, scanner)
+        summary = upload_fastq(args, files_pg, hcpm)
+        # Failed files are returned again by the next scan
+        scanner.defer(summary["failed"])
+        scanner.commit()
 
     if args.query:
         file_lst = search(args,hcpm)
@@ -1,21 +1,31 @@
 #!/usr/bin/env python3
 
 import argparse
-import pandas as pd
 import os
 import datetime 
+import functools
 import logging
-import fnmatch
 import glob
-from NGPinterface.hcp import HCPManager
+import subprocess
+import sys
 from tools.samplesheet_parser import sample_sheet
+from tools.parallel import map_files
+from tools.stages import StageGraph
+from tools.run_state import fingerprint
+from tools.readiness import StableTracker, nextseq_ready, settled_files, take_ready
 from tools.check_files import check_files
+from tools.scan_state import ScanState
+from tools.artifact_cache import ArtifactCache
 from tools import log
 from tools.microReport import nextseq as microreport
 from tools.clc_sync import clc
 from tools.emailer import email_micro
+from tools.pangolin_outputs import postprocess, NEXTSEQ
+from tools.hcp_upload import upload_stage, run_pipeline
 
-def arg():
+ERROR_LOG = "/medstore/logs/pipeline_logfiles/sars-cov-2-typing/nextseqwrapper_cronjob.log"
+
+def arg(argv=None):
     parser = argparse.ArgumentParser(prog="direkttest_cronscript.py")
     requiredNamed = parser.add_argument_group('required arguments')
 
@@ -33,7 +43,29 @@ def arg():
                             help="CLC password")
     parser.add_argument("--sshkey", 
                             help="GENSAM upload sshkey- password")
-    args = parser.parse_args()
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                            help="number of processes for the per-file conversions")
+    parser.add_argument("--stage-workers", type=int, default=4,
+                            help="number of stages run at the same time")
+    parser.add_argument("--ready-marker",
+                            help="file in the run directory written when the run is complete")
+    parser.add_argument("--stable-scans", type=int, default=2,
+                            help="without a marker, number of runs the run directory must look the same")
+    parser.add_argument("--settle-age", type=int, default=300,
+                            help="seconds since the last change before a file is uploaded")
+    parser.add_argument("-w", "--workers", type=int, default=4,
+                            help="number of parallel HCP uploads")
+    parser.add_argument("--retries", type=int, default=3,
+                            help="upload attempts per file")
+    parser.add_argument("--index-cache",
+                            default="/medstore/results/clinical/SARS-CoV-2-typing/hcp_index",
+                            help="directory for the cached HCP object listing")
+    parser.add_argument("--index-ttl", type=int, default=3600,
+                            help="seconds before the cached HCP object listing is refreshed")
+    parser.add_argument("--scan-state",
+                            default="/medstore/results/clinical/SARS-CoV-2-typing/scan_state",
+                            help="directory for the incremental file scan state")
+    args = parser.parse_args(argv)
 
     return args
 
@@ -41,6 +73,10 @@ def arg():
 def setup_logger(name, log_path=None):
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
+    # The watcher runs the pipeline many times in one process, start a new log every run
+    for handle in list(logger.handlers):
+        logger.removeHandler(handle)
+        handle.close()
 
     stream_handle = logging.StreamHandler()
     stream_handle.setLevel(logging.DEBUG)
@@ -56,30 +92,17 @@ def setup_logger(name, log_path=None):
     return logger
 
 
-@log.log_error("/medstore/logs/pipeline_logfiles/sars-cov-2-typing/nextseqwrapper_cronjob.log")
-def pangolin(path_list):
-    # Specifics for nextseq data uploaded to GENSAM
-    for f in path_list:
-        if fnmatch.fnmatch(os.path.basename(f), "*_lineage_report.txt"):
-            print("updating: " + f)
-            df = pd.DataFrame(pd.read_csv(f, sep=",")) # csv file input
-            for i,row in df.iterrows():
-                df["taxon"] = df["taxon"].replace(row["taxon"], "_".join(row["taxon"].split("_")[1:4])) # change taxon names
-
-            df.to_csv(os.path.dirname(os.path.abspath(f))+"/"+os.path.basename(os.path.dirname(f))+"_"+os.path.basename(f).replace(".txt","_gensam.txt"), index=None, header=True, sep="\t") # tab sep output without NULL
-
-    # Specifics for nextseq data uploaded to HCP
-    for f in path_list:
-        if fnmatch.fnmatch(os.path.basename(f), "*_lineage_report.txt"):
-            print("updating: " + f)
-            df = pd.DataFrame(pd.read_csv(f, sep=",")).fillna(value = "NULL") # csv file input, fill empty with NULL
-            for i,row in df.iterrows():
-                df["taxon"] = df["taxon"].replace(row["taxon"], "_".join(row["taxon"].split("_")[1:4])) # change taxon names
+@log.log_error(ERROR_LOG)
+def pangolin(path_list, cache, jobs, logger):
+    # Specifics for nextseq data uploaded to GENSAM and HCP
+    summary = postprocess(path_list, NEXTSEQ, cache, workers=jobs, log_path=ERROR_LOG, logger=logger)
+    if summary["failed"]:
+        # Fail the stage, so the scan state is kept and the reports are converted again next run
+        raise IOError(f'Pangolin conversion failed for {len(summary["failed"])} files')
+    return [out for outputs in summary["ok"].values() for out in outputs]
 
-            df.to_csv(os.path.dirname(os.path.abspath(f))+"/"+os.path.basename(os.path.dirname(f))+"_"+os.path.basename(f).replace(".txt","_fillempty.txt"), index=None, header=True, sep="\t") # tab sep output
 
-
-@log.log_error("/medstore/logs/pipeline_logfiles/sars-cov-2-typing/nextseqwrapper_cronjob.log")
+@log.log_error(ERROR_LOG)
 # Send artic csv file and pangolin result file to micro sftp
 def micro_report():
     nextseqdir = "/medstore/results/clinical/SARS-CoV-2-typing/nextseq_data/" 
@@ -91,53 +114,55 @@ def micro_report():
     microreport(nextseqdir, articdir, syncdir, syncedfiles, logfile) 
 
 
-@log.log_error("/medstore/logs/pipeline_logfiles/sars-cov-2-typing/nextseqwrapper_cronjob.log")
+@log.log_error(ERROR_LOG)
 # Parse samplesheet and put in metadata json, for HCP upload
-def samplesheet_parser(samplesheet_path,run):
-    sample_sheet(samplesheet_path,run)
+def samplesheet_parser(samplesheet_path,run,jobs,logger):
+    summary = map_files(functools.partial(sample_sheet, run=run), samplesheet_path, workers=jobs, log_path=ERROR_LOG, logger=logger)
+    if summary["failed"]:
+        raise IOError(f'Samplesheet parsing failed for {len(summary["failed"])} files')
 
 
-@log.log_error("/medstore/logs/pipeline_logfiles/sars-cov-2-typing/nextseqwrapper_cronjob.log")
+@log.log_error(ERROR_LOG)
 # Import consensus fasta files to CLC
 def clc_sync(password, run):
     # Variables for CLC upload
     server = "medair.sahlgrenska.gu.se"
     port = 7777
     user = "cmduser"
-    clc(password,run,server,port,user) 
+    results = clc(password,run,server,port,user)
+    failed = [path for path, (returncode, stderr) in results.items() if returncode != 0]
+    if failed:
+        raise RuntimeError(f'CLC import failed for {len(failed)} files: {", ".join(failed)}')
 
 
-@log.log_error("/medstore/logs/pipeline_logfiles/sars-cov-2-typing/nextseqwrapper_cronjob.log")
+@log.log_error(ERROR_LOG)
 # Upload files and json to selected bucket on HCP.
-def upload_fastq(hcp_paths,hcpm,logger):
-    for file_pg in hcp_paths:
-        if hcpm.search_objects(file_pg) is None:
-            try:
-                hcpm.upload_file(file_pg, "covid-wgs/"+os.path.basename(file_pg))
-                logger.info(f"uploading: {file_pg}")
-            except Exception as e:
-                logger.error(e)
-                continue
-        else:
-            logger.error(f"Object already exists {file_pg}")
-            continue
-
-
-@log.log_error("/medstore/logs/pipeline_logfiles/sars-cov-2-typing/nextseqwrapper_cronjob.log")
+def upload_fastq(hcp_paths,hcpm,logger,args):
+    upload_stage(args, hcp_paths, logger, hcpm)
+
+
+@log.log_error(ERROR_LOG)
 # Upload fasta, fastq and pangolin files to GENSAM
 def gensam_upload(args,run):
     cmd = ["gensamupload/gensamupload.py", "-r", run, "--sshkey-password", args.sshkey]
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=False)
+    # gensamupload imports from tools/, put the repository root on its path
+    root = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")])))
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=False, env=env)
 
     while process.wait() is None:
         pass
     process.stdout.close()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
 
 
-def main():
-    args = arg()
+# Returns False if a stage failed, None if files are not ready yet
+# hcpm: connected HCPManager to reuse, None connects when the upload starts
+def pipeline(args, hcpm=None):
 
     # Get runID
+    run = None
     if args.run:
         run = args.run
     else:
@@ -149,38 +174,79 @@ def main():
     logfile = os.path.join("/medstore/logs/pipeline_logfiles/sars-cov-2-typing/HCP_upload/", "HCP_upload_nextseq" + now.strftime("%y%m%d_%H%M%S") + ".log")
     logger = setup_logger('hcp_log', logfile)
 
-    # Fix pangolin files for HCP and GENSAM
-    pangolin_path = check_files("/medstore/results/clinical/SARS-CoV-2-typing/nextseq_data/2*/lineage/*")
+    if run is None:
+        # Nothing changed in the last 12 hours, like no new pangolin files below
+        logger.info('No new run found')
+        return True
+
+    # Wait until the run directory is completely written
+    rundir = f"/medstore/results/clinical/SARS-CoV-2-typing/nextseq_data/{run}"
+    tracker = StableTracker(os.path.join(args.scan_state, "nextseq_ready.json"))
+    ready = nextseq_ready(rundir, tracker, args.ready_marker, args.stable_scans)
+    tracker.save()
+    if not ready:
+        logger.info(f'{run} is still being written, waiting for the next run')
+        return None
+
+    # Only new or changed files since the last successful run
+    scanner = ScanState(os.path.join(args.scan_state, "nextseq.json"))
+
+    def settled(paths):
+        # The run directory was checked as a whole, that includes the files this pipeline writes to it
+        ours = [path for path in paths if path.startswith(rundir + os.sep)]
+        ready, waiting = settled_files([path for path in paths if not path.startswith(rundir + os.sep)], args.settle_age)
+        return ours + ready, waiting
+
+    pangolin_path = take_ready(scanner, scanner.scan("/medstore/results/clinical/SARS-CoV-2-typing/nextseq_data/2*/lineage/*"), settled, logger)
     if len(pangolin_path) < 1:
-        sys.exit()
-    else:
-        pangolin(pangolin_path)
-
-    # Sync pangolin and artic files to micro sftp
-    micro_report()
-
-    # Parse nextseq samplesheet for metadata
-    samplesheet_path = check_files(f"/seqstore/instruments/nextseq_500175_gc/Demultiplexdir/{run}/SampleSheet.csv")
-    if not os.path.exists(f"/medstore/results/clinical/SARS-CoV-2-typing/nextseq_data/{run}/metadata"):
-        os.makedirs(f"/medstore/results/clinical/SARS-CoV-2-typing/nextseq_data/{run}/metadata")
+        return None if scanner.deferred else True
 
-    samplesheet_parser(samplesheet_path,run)
+    samplesheet = f"/seqstore/instruments/nextseq_500175_gc/Demultiplexdir/{run}/SampleSheet.csv"
+    scanned = {}
 
-    # Import consensus fasta files to CLC
-    clc_sync(args.password,run)
+    def hcp_paths():
+        # Scanned when the upload starts, after pangolin and samplesheet wrote their files
+        if "hcp" not in scanned:
+            scanned["hcp"] = take_ready(scanner, scanner.scan("/medstore/results/clinical/SARS-CoV-2-typing/nextseq_data/2*/*/*"), settled, logger)
+        return scanned["hcp"]
 
-    # Upload files to HCP
-    hcp_paths = check_files("/medstore/results/clinical/SARS-CoV-2-typing/nextseq_data/2*/*/*")
-    upload_fastq(hcp_paths, hcpm, logger)
+    def metadata():
+        # Parse nextseq samplesheet for metadata
+        # The stage fingerprint decides if it has to be parsed again, not the age of the file
+        samplesheet_path = [samplesheet] if os.path.exists(samplesheet) else []
+        os.makedirs(f"/medstore/results/clinical/SARS-CoV-2-typing/nextseq_data/{run}/metadata", exist_ok=True)
+        return samplesheet_parser(samplesheet_path,run,args.jobs,logger)
 
     # Notify Microbiology about new data
     email_subject = 'Results from Artic pipeline now on sFTP and CLC'
     email_body = f'Artic/pangolin results and virus fasta from the run {run} is now available on the sFTP and CLC, respectively.'
-    email_micro(email_subject, email_body)
-    
+
+    # Stages start when the stages they depend on are done, CLC, HCP and GENSAM run side by side
+    graph = StageGraph(logger)
+    # Fix pangolin files for HCP and GENSAM
+    # A rerun of the run skips the stages whose inputs haven't changed
+    graph.add("pangolin", lambda: pangolin(pangolin_path, ArtifactCache(os.path.join(args.scan_state, "nextseq_conversions.json")), args.jobs, logger),
+              fingerprint=lambda: fingerprint(pangolin_path))
+    # Sync pangolin and artic files to micro sftp
+    graph.add("micro_report", micro_report, deps=["pangolin"])
+    graph.add("samplesheet", metadata, fingerprint=lambda: fingerprint([samplesheet]))
+    # Import consensus fasta files to CLC
+    graph.add("clc_sync", lambda: clc_sync(args.password,run),
+              fingerprint=lambda: fingerprint(glob.glob(f"{rundir}/fasta/*.fa")))
+    # Connects to HCP unless the watcher passed its connected client
+    graph.add("hcp_upload", lambda: upload_fastq(hcp_paths(), hcpm, logger, args),
+              deps=["pangolin", "samplesheet"], fingerprint=lambda: fingerprint(hcp_paths()))
+    graph.add("email_micro", lambda: email_micro(email_subject, email_body), deps=["micro_report", "clc_sync"])
     # Upload files to GENSAM
-    gensam_upload(args,run)
+    graph.add("gensam_upload", lambda: gensam_upload(args,run), deps=["pangolin"])
+
+    return run_pipeline(graph, scanner, args.scan_state, f"nextseq/{run}", logger, workers=args.stage_workers)
+
 
+def main():
+    args = arg()
+    if pipeline(args) is False:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
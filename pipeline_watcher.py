@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# Long running replacement for the hourly cron jobs.
+# Watches nextseq_data, eurofins_data, direkttest and the micro-gensam inbox
+# (inotify, or polling without inotify_simple) and runs the matching
+# pipeline once a changed directory has been quiet for --settle seconds.
+# The wrappers are imported once and the HCP client is connected once and
+# reused by every run. Eurofins data is pulled from their ftp, so that
+# pipeline also runs every --eurofins-interval seconds.
+# Pipelines run one at a time, changes seen meanwhile are queued.
+
+import argparse
+import datetime
+import logging
+import os
+import subprocess
+import time
+import nextseq_cronscript
+import eurofins_cronscript
+import direkttest_cronscript
+from tools.watch import watcher, ignored
+
+NEXTSEQ_DATA = "/medstore/results/clinical/SARS-CoV-2-typing/nextseq_data"
+EUROFINS_DATA = "/medstore/results/clinical/SARS-CoV-2-typing/eurofins_data/goteborg"
+DIREKTTEST = "/medstore/results/clinical/SARS-CoV-2-typing/direkttest"
+MICRO_GENSAM = "/seqstore/remote/inbox/micro-gensam/shared"
+
+# Watched directory: depth below it that is watched
+ROOTS = {NEXTSEQ_DATA: 2, EUROFINS_DATA: 1, DIREKTTEST: 0, MICRO_GENSAM: 0}
+
+
+def arg():
+    parser = argparse.ArgumentParser(prog="pipeline_watcher.py")
+    requiredNamed = parser.add_argument_group('required arguments')
+
+    requiredNamed.add_argument("-ep", "--endpoint",
+                            help="endpoint url")
+    requiredNamed.add_argument("-aki", "--aws_access_key_id",
+                            help="aws access key id")
+    requiredNamed.add_argument("-sak", "--aws_secret_access_key",
+                            help="aws secret access key")
+    requiredNamed.add_argument("-b", "--bucket",
+                            help="bucket name")
+    parser.add_argument("-u", "--eurofins-username",
+                            help="username for eurofins sftp connection")
+    parser.add_argument("--eurofins-password",
+                            help="password for eurofins sftp connection")
+    parser.add_argument("--clc-password",
+                            help="CLC password")
+    parser.add_argument("--sshkey",
+                            help="GENSAM upload sshkey- password")
+    parser.add_argument("--settle", type=int, default=120,
+                            help="seconds a directory must be quiet before its pipeline starts")
+    parser.add_argument("--eurofins-interval", type=int, default=3600,
+                            help="seconds between eurofins ftp syncs")
+    parser.add_argument("--retry-delay", type=int, default=900,
+                            help="seconds before a failed pipeline is run again")
+    parser.add_argument("--poll", action="store_true",
+                            help="poll the directories instead of using inotify")
+    parser.add_argument("--poll-interval", type=int, default=30,
+                            help="seconds between polls")
+    parser.add_argument("--log",
+                            default="/medstore/logs/pipeline_logfiles/sars-cov-2-typing/pipeline_watcher.log",
+                            help="log file")
+    args = parser.parse_args()
+
+    return args
+
+
+def setup_logger(name, log_path=None):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+
+    stream_handle = logging.StreamHandler()
+    stream_handle.setLevel(logging.DEBUG)
+    stream_handle.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logger.addHandler(stream_handle)
+
+    if log_path:
+        file_handle = logging.FileHandler(log_path, 'a')
+        file_handle.setLevel(logging.DEBUG)
+        file_handle.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        logger.addHandler(file_handle)
+
+    return logger
+
+
+# Command line of the wrappers, so their defaults apply
+def hcp_argv(args):
+    return ["-ep", args.endpoint, "-aki", args.aws_access_key_id,
+            "-sak", args.aws_secret_access_key, "-b", args.bucket]
+
+
+def options(**kwargs):
+    argv = []
+    for flag, value in kwargs.items():
+        if value is not None:
+            argv += [flag, value]
+    return argv
+
+
+# Pipeline to run for a change under a watched directory, None to ignore it
+def job(root, name):
+    if name and ignored(name):
+        return None
+    if root == NEXTSEQ_DATA:
+        if name is None:
+            # Events were lost, let the wrapper find the latest run
+            return ("nextseq", None)
+        return ("nextseq", name) if name.startswith("2") else None
+    if root == EUROFINS_DATA:
+        # New date directories come with their name, "" is the root itself
+        return None if name == "" else ("eurofins", None)
+    if root == DIREKTTEST:
+        return ("direkttest", None)
+    if root == MICRO_GENSAM:
+        # Files moved to sent_files by the upload itself
+        return None if name == "sent_files" else ("micro_gensam", None)
+    return None
+
+
+def run_job(key, args, hcpm):
+    pipeline, run = key
+    if pipeline == "nextseq":
+        argv = hcp_argv(args) + options(**{"-r": run, "-p": args.clc_password, "--sshkey": args.sshkey})
+        return nextseq_cronscript.pipeline(nextseq_cronscript.arg(argv), hcpm)
+    if pipeline == "eurofins":
+        argv = hcp_argv(args) + options(**{"-u": args.eurofins_username, "-p": args.eurofins_password})
+        return eurofins_cronscript.pipeline(eurofins_cronscript.arg(argv), hcpm)
+    if pipeline == "direkttest":
+        return direkttest_cronscript.pipeline(direkttest_cronscript.arg(hcp_argv(args)), hcpm)
+    if pipeline == "micro_gensam":
+        root = os.path.dirname(os.path.abspath(__file__))
+        script = os.path.join(root, "gensamupload", "micro_gensamupload.py")
+        # gensamupload imports from tools/, put the repository root on its path
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")])))
+        return subprocess.run([script] + options(**{"--sshkey-password": args.sshkey}), env=env).returncode == 0
+    raise ValueError(f'Unknown pipeline {pipeline}')
+
+
+def main():
+    args = arg()
+    logger = setup_logger('pipeline_watcher', args.log)
+
+    # Connect to HCP once, all runs share the client
+    from NGPinterface.hcp import HCPManager
+    hcpm = HCPManager(args.endpoint, args.aws_access_key_id, args.aws_secret_access_key)
+    hcpm.attach_bucket(args.bucket)
+
+    roots = {root: depth for root, depth in ROOTS.items() if os.path.isdir(root)}
+    watch = watcher(roots, interval=args.poll_interval, poll=args.poll)
+    logger.info(f'Watching {", ".join(roots)} with {type(watch).__name__}')
+
+    # (pipeline, run): time of the last change
+    pending = {("eurofins", None): 0}
+    last_eurofins = time.monotonic()
+    while True:
+        for root, names in watch.wait(timeout=5).items():
+            for name in names:
+                key = job(root, name)
+                if key is not None:
+                    pending[key] = time.monotonic()
+
+        if time.monotonic() - last_eurofins > args.eurofins_interval:
+            pending.setdefault(("eurofins", None), 0)
+
+        for key, changed in sorted(pending.items(), key=lambda item: item[1]):
+            if time.monotonic() - changed < args.settle:
+                continue
+            del pending[key]
+            if key[0] == "eurofins":
+                last_eurofins = time.monotonic()
+            start = datetime.datetime.now()
+            logger.info(f'Starting {key[0]}' + (f' for {key[1]}' if key[1] else ''))
+            try:
+                complete = run_job(key, args, hcpm)
+            except (Exception, SystemExit):
+                # A sys.exit deep in a pipeline must not stop the watcher
+                logger.exception(f'{key[0]} failed')
+                complete = False
+            status = {True: "finished", False: "failed", None: "waiting for data"}[complete]
+            logger.info(f'{key[0]} {status} in {(datetime.datetime.now() - start).total_seconds():.0f} s')
+            if complete is None:
+                # Data still being written, look again after the settle time
+                pending.setdefault(key, time.monotonic())
+            elif not complete:
+                pending.setdefault(key, time.monotonic() + args.retry_delay)
+            # Check for new changes before the next pipeline
+            break
+
+
+if __name__ == "__main__":
+    main()
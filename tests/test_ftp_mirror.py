@@ -0,0 +1,129 @@
+# tools.ftp_mirror against a local FTP server (pyftpdlib)
+
+import ftplib
+import logging
+import os
+import threading
+import time
+import pytest
+from tools import ftp_mirror
+
+pyftpdlib = pytest.importorskip("pyftpdlib")
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import FTPServer
+
+logger = logging.getLogger("test_ftp_mirror")
+
+
+@pytest.fixture
+def server(tmp_path):
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    authorizer = DummyAuthorizer()
+    authorizer.add_user("user", "secret", str(remote), perm="elr")
+    handler = type("Handler", (FTPHandler,), {"authorizer": authorizer})
+    ftpd = FTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=ftpd.serve_forever, kwargs={"timeout": 0.1})
+    thread.start()
+    yield remote, ftpd.address[1]
+    ftpd.close_all()
+    thread.join()
+
+
+def write(path, data, age=None):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    if age is not None:
+        then = time.time() - age
+        os.utime(path, (then, then))
+
+
+def run(port, tmp_path, **kwargs):
+    return ftp_mirror.mirror("127.0.0.1", port, "user", "secret", str(tmp_path / "local"), logger,
+                             streams=2, statedir=str(tmp_path / "state"), retries=1, **kwargs)
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    (tmp_path / "local").mkdir()
+    (tmp_path / "state").mkdir()
+
+
+def test_unchanged_tree_is_not_listed_or_downloaded_again(server, tmp_path, dirs, monkeypatch):
+    remote, port = server
+    write(remote / "2021" / "a.txt", b"a" * 100, age=7200)
+    write(remote / "2021" / "md5sums.txt", b"x  a.txt\n", age=7200)
+
+    summary = run(port, tmp_path)
+    assert sorted(summary["downloaded"]) == ["2021/a.txt", "2021/md5sums.txt"]
+    assert (tmp_path / "local" / "2021" / "a.txt").read_bytes() == b"a" * 100
+
+    listed = []
+    mlsd = ftplib.FTP.mlsd
+    monkeypatch.setattr(ftplib.FTP, "mlsd", lambda self, path="", facts=[]: listed.append(path) or mlsd(self, path, facts))
+    summary = run(port, tmp_path)
+    assert summary == {"downloaded": [], "failed": []}
+    # Only the root, the settled date directory comes from the cache
+    assert listed == ["/"]
+
+
+def test_interrupted_download_is_resumed(server, tmp_path, dirs, monkeypatch):
+    remote, port = server
+    data = os.urandom(5000)
+    write(remote / "2021" / "a.txt", data, age=7200)
+    write(tmp_path / "local" / "2021" / ".a.txt.part", data[:2000])
+
+    offsets = []
+    retrbinary = ftplib.FTP.retrbinary
+    def record(self, cmd, callback, blocksize=8192, rest=None):
+        offsets.append(rest)
+        return retrbinary(self, cmd, callback, blocksize, rest)
+    monkeypatch.setattr(ftplib.FTP, "retrbinary", record)
+
+    summary = run(port, tmp_path)
+    assert summary["downloaded"] == ["2021/a.txt"]
+    assert offsets == [2000]
+    assert (tmp_path / "local" / "2021" / "a.txt").read_bytes() == data
+    assert not (tmp_path / "local" / "2021" / ".a.txt.part").exists()
+
+
+def test_file_growing_in_place_is_fetched_again(server, tmp_path, dirs):
+    remote, port = server
+    write(remote / "2021" / "md5sums.txt", b"x  a.txt\n", age=7200)
+    # Still being uploaded, the directory hasn't settled
+    write(remote / "2021" / "a.txt", b"a" * 100)
+    dir_mtime = os.stat(remote / "2021").st_mtime
+
+    assert "2021/a.txt" in run(port, tmp_path)["downloaded"]
+
+    with open(remote / "2021" / "a.txt", "ab") as f:
+        f.write(b"b" * 4900)
+    assert os.stat(remote / "2021").st_mtime == dir_mtime
+
+    summary = run(port, tmp_path)
+    assert summary["downloaded"] == ["2021/a.txt"]
+    assert (tmp_path / "local" / "2021" / "a.txt").stat().st_size == 5000
+
+
+def test_file_grown_since_listing_is_listed_again(server, tmp_path, dirs, monkeypatch):
+    remote, port = server
+    write(remote / "2021" / "a.txt", b"a" * 100, age=7200)
+
+    # The file grows between the listing and the download
+    list_tree = ftp_mirror.list_tree
+    def grow(ftp, cache, *args, **kwargs):
+        # list_tree calls itself for the subdirectories
+        monkeypatch.setattr(ftp_mirror, "list_tree", list_tree)
+        files = list_tree(ftp, cache, *args, **kwargs)
+        with open(remote / "2021" / "a.txt", "ab") as f:
+            f.write(b"b" * 4900)
+        then = time.time() - 7200
+        os.utime(remote / "2021" / "a.txt", (then, then))
+        return files
+    monkeypatch.setattr(ftp_mirror, "list_tree", grow)
+    assert run(port, tmp_path)["failed"] == ["2021/a.txt"]
+
+    summary = run(port, tmp_path)
+    assert summary["downloaded"] == ["2021/a.txt"]
+    assert (tmp_path / "local" / "2021" / "a.txt").stat().st_size == 5000
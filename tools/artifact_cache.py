@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Cache of derived files (csv, _fillempty.txt, _gensam.txt, ...).
+# For every input the cache keeps its sha256, the transform that produced
+# the outputs and the output paths. A conversion is skipped when the input
+# has the same content, the transform is the same and all outputs exist.
+# The sha256 is only recomputed when the size or mtime of the input changed.
+
+import hashlib
+import json
+import os
+from tools.atomic import read_json, write_json
+from tools.hashing import file_digest
+
+
+# Key of a transform: its version plus a hash of its settings, so changing
+# an output variant also reruns the conversion
+def transform_key(version, spec=None):
+    settings = hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:12]
+    return f"{version}:{settings}"
+
+
+class ArtifactCache:
+    def __init__(self, path):
+        self.path = path
+        self.entries = read_json(path, {})
+        self.dirty = False
+        self.digests = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _digest(self, path, st):
+        entry = self.entries.get(os.path.abspath(path))
+        if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+            return entry["sha256"]
+        # fresh() and record() of the same input only hash it once
+        key = (os.path.abspath(path), st.st_size, st.st_mtime)
+        if key not in self.digests:
+            self.digests[key] = file_digest(path)
+        return self.digests[key]
+
+    # True if the outputs of this input and transform are up to date
+    def fresh(self, path, transform):
+        entry = self.entries.get(os.path.abspath(path))
+        if entry is None or entry["transform"] != transform:
+            return False
+        if not all(os.path.exists(out) for out in entry["outputs"]):
+            return False
+        st = os.stat(path)
+        if self._digest(path, st) != entry["sha256"]:
+            return False
+        if entry["size"] != st.st_size or entry["mtime"] != st.st_mtime:
+            # Touched but not changed, remember the new stat
+            entry["size"], entry["mtime"] = st.st_size, st.st_mtime
+            self.dirty = True
+        return True
+
+    def record(self, path, transform, outputs):
+        st = os.stat(path)
+        self.entries[os.path.abspath(path)] = {
+            "sha256": self._digest(path, st), "size": st.st_size, "mtime": st.st_mtime,
+            "transform": transform, "outputs": [os.path.abspath(out) for out in outputs],
+        }
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        write_json(self.path, self.entries)
+        self.dirty = False
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# Atomic file writes: write to a temp file in the same directory and
+# rename it over the target, so readers never see a partial file.
+
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+
+
+# Mode of the existing file, or the default mode for a new file
+def file_mode(path):
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+# Exclusive lock for a read-modify-write of path, held on path + ".lock"
+# so it survives the rename of atomic_write
+@contextlib.contextmanager
+def locked(path):
+    with open(path + ".lock", "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode="w"):
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix="." + os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        # mkstemp creates the file as 0600, give it the mode a plain open() would
+        os.chmod(tmp, file_mode(path))
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def write_json(path, data):
+    with atomic_write(path) as f:
+        json.dump(data, f, indent=4)
+
+
+def read_json(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
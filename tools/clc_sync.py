@@ -3,60 +3,99 @@
 import os
 import subprocess
 import argparse
+import bisect
 import glob
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+CLCSERVER = "/apps/clcservercmdline/clcserver"
 
 def arg():
     parser = argparse.ArgumentParser(prog="clc_sync.py")
     parser.add_argument("-r", "--run", help="Name of run")
     parser.add_argument("-p", "--password", help="CLC password")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="number of clcserver imports run at the same time")
+    parser.add_argument("--clcserver", default=CLCSERVER, help="path to the clcserver command line client")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="only list the files that would be imported")
     args = parser.parse_args()
     return args
 
 
-def clc(password,run,server,port,user):
+# Run clcserver commands, at most `workers` at a time.
+# Returns {name: (exit code, stderr)}, stderr is also written to the log file.
+def run_commands(commands, log_file, workers=4):
+    def run_one(cmd):
+        process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False)
+        return process.returncode, process.stderr.decode(errors="replace")
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(run_one, cmd): name for name, cmd in commands.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            results[name] = future.result()
+            returncode, stderr = results[name]
+            if stderr:
+                log_file.write(stderr)
+            if returncode != 0:
+                log_file.write(f"clcserver exited with {returncode} for {name}\n")
+    return results
+
+
+# Sorted names in the CLC run folder, from one directory listing
+def clc_index(clcdir):
+    if not os.path.isdir(clcdir):
+        return []
+    with os.scandir(clcdir) as it:
+        return sorted(entry.name for entry in it)
+
+
+# True if a name in the sorted index starts with prefix, like the glob
+# "Consensus_<sample>*" used before, in O(log n)
+def has_prefix(index, prefix):
+    i = bisect.bisect_left(index, prefix)
+    return i < len(index) and index[i].startswith(prefix)
+
+
+def clc(password,run,server,port,user,workers=4,clcserver=CLCSERVER,dry_run=False):
     log_file=open('/medstore/logs/pipeline_logfiles/sars-cov-2-typing/nextseq_clcimport.log','a')
+    login = [clcserver, "-S", server, "-P", str(port), "-U", user, "-W", password]
     # Check if directory exists
     if os.path.exists(f"/medstore/CLC_Data_Folders/Microbiology/SARS-CoV-2_Clinical/Illumina/{run}"):
         pass
+    elif dry_run:
+        print(f"CLC run folder {run} would be created")
     else:
         # Create directory on CLC
-        cmd = ["/apps/clcservercmdline/clcserver", "-S", server, 
-                                                "-P", str(port), 
-                                                "-U", user, 
-                                                "-W", password, 
-                                                "-A", "mkdir", 
-                                                "-t", "clc://server/CLC_Data_Folders/Microbiology/SARS-CoV-2_Clinical/Illumina/",
-                                                "-n", run]    
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=log_file, shell=False)
-
-        while process.wait() is None:
-            pass
-        process.stdout.close()
-
-    # Import fasta files to CLC
-    for path in glob.glob(f"/medstore/results/clinical/SARS-CoV-2-typing/nextseq_data/{run}/fasta/*.fa", recursive=True):
+        cmd = login + ["-A", "mkdir", 
+                       "-t", "clc://server/CLC_Data_Folders/Microbiology/SARS-CoV-2_Clinical/Illumina/",
+                       "-n", run]    
+        run_commands({run: cmd}, log_file)
+
+    # Import fasta files missing on CLC
+    existing = clc_index(f"/medstore/CLC_Data_Folders/Microbiology/SARS-CoV-2_Clinical/Illumina/{run}")
+    imports = {}
+    for path in sorted(glob.glob(f"/medstore/results/clinical/SARS-CoV-2-typing/nextseq_data/{run}/fasta/*.fa")):
         # Check if file exists on CLC
-        clc_file = "Consensus_"+os.path.basename(path.replace(".fa","*"))
-        for clc in glob.glob(f"/medstore/CLC_Data_Folders/Microbiology/SARS-CoV-2_Clinical/Illumina/{run}/{clc_file}", recursive=True):
-            if os.path.exists(clc):
-                pass
-            else:
-                cmd2 = ["/apps/clcservercmdline/clcserver", "-S", server, 
-                                                            "-P", str(port), 
-                                                            "-U", user, 
-                                                            "-W", password, 
-                                                            "-G", "clinical-production", 
-                                                            "-A", "import", 
-                                                            "-f", "fasta", 
-                                                            "-s", f"clc://serverfile/{path}", 
-                                                            "-d", f"clc://server/CLC_Data_Folders/Microbiology/SARS-CoV-2_Clinical/Illumina/{run}"]
-                process2 = subprocess.Popen(cmd2, stdout=subprocess.PIPE, stderr=log_file, shell=False)
-
-                while process2.wait() is None:
-                    pass
-                process2.stdout.close()
+        if has_prefix(existing, "Consensus_" + os.path.basename(path)[:-len(".fa")]):
+            continue
+        imports[path] = login + ["-G", "clinical-production", 
+                                 "-A", "import", 
+                                 "-f", "fasta", 
+                                 "-s", f"clc://serverfile/{path}", 
+                                 "-d", f"clc://server/CLC_Data_Folders/Microbiology/SARS-CoV-2_Clinical/Illumina/{run}"]
+
+    if dry_run:
+        print(f"{len(imports)} file(s) would be imported to CLC run folder {run}:")
+        for path in imports:
+            print(path)
+        log_file.close()
+        return {}
+
+    # Run the imports in parallel, one clcserver process per file
+    results = run_commands(imports, log_file, workers)
 
     log_file.close()
+    return results
 
 
 def main():
@@ -69,7 +108,13 @@ def main():
     port = 7777
     user = "cmduser"
 
-    clc(password,run,server,port,user)
+    results = clc(password,run,server,port,user,args.workers,args.clcserver,args.dry_run)
+    if args.dry_run:
+        return
+    failed = [path for path, (returncode, stderr) in results.items() if returncode != 0]
+    print(f"Imported {len(results) - len(failed)} files, {len(failed)} failed")
+    for path in failed:
+        print(f"Failed: {path}")
 
 
 if __name__ == "__main__":
@@ -1,37 +1,97 @@
 #!/usr/bin/env python3
 
-import openpyxl
 import argparse
-import pandas as pd
 import os
 import datetime as dt
-import fnmatch
-import glob
+import csv
+from tools.atomic import atomic_write
+from tools.artifact_cache import transform_key
+from tools.parallel import map_files
+from tools.scan_state import ScanState
+
+# Bump when the csv output changes
+VERSION = "streaming-2"
 
 def arg():
     parser = argparse.ArgumentParser(prog="direkttest_csv.py")
     parser.add_argument("-f", "--filepath", help="path to excel file to parse")
     parser.add_argument("-a", "--automatic", action="store_true", help="automatic file search from direkttest")
+    parser.add_argument("--scan-state", default="/medstore/results/clinical/SARS-CoV-2-typing/scan_state",
+                        help="directory for the incremental file scan state of -a")
 
     args = parser.parse_args()
     return args
 
 
-def check_files():
-    now = dt.datetime.now()
-    ago = now-dt.timedelta(minutes=1440)
+# New or changed workbooks since the last run
+def check_files(scanner):
+    return scanner.scan('/medstore/results/clinical/SARS-CoV-2-typing/direkttest/direkttest_*.xlsx', first_window=1440)
+
+
+# Value of a cell as written to the csv.
+# Dates are written like pandas did, "2021-03-01", or "2021-03-01 12:30:00"
+# with a time of day. Unlike pandas, integers stay integers in columns with
+# empty cells (pandas wrote 25.0 there) and a date column with some times of
+# day doesn't get 00:00:00 added to its other dates.
+def cell(value):
+    if value is None:
+        return "NULL"
+    if isinstance(value, dt.datetime):
+        if value.time() == dt.time():
+            return value.date().isoformat()
+        return value.isoformat(sep=" ")
+    return value
+
+
+# Stream the first sheet row by row (openpyxl read-only mode), fill empty
+# cells with NULL and write the csv as we go, memory use stays flat.
+# Written to a temp file and renamed, so a half written csv is never uploaded.
+# With an ArtifactCache the workbook is skipped if the csv is up to date.
+def csv_from_excel(path, cache=None):
+    out = os.path.abspath(path).replace("xlsx","csv")
+    transform = transform_key(VERSION)
+    if cache is not None and cache.fresh(path, transform):
+        return out
+    # openpyxl is only loaded when a workbook is converted
+    import openpyxl
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, ())
+        width = len(header)
+        with atomic_write(out, "w") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            # Same names as pandas for columns without a header
+            writer.writerow([f"Unnamed: {i}" if name is None else name for i, name in enumerate(header)])
+            for row in rows:
+                # Skip blank rows, like pandas
+                if all(value is None for value in row):
+                    continue
+                row = tuple(row[:width]) + (None,) * (width - len(row))
+                writer.writerow([cell(value) for value in row])
+    finally:
+        wb.close()
+    if cache is not None:
+        cache.record(path, transform, [out])
+    return out
+
 
-    path_list = []
-    for path in glob.glob('/medstore/results/clinical/SARS-CoV-2-typing/direkttest/direkttest_*.xlsx', recursive=True):
-        st = os.stat(path)
-        mtime = dt.datetime.fromtimestamp(st.st_ctime)
-        if mtime > ago:
-            #print('%s modified %s'%(path, mtime))
-            path_list.append(path)
-    return path_list
+# Convert workbooks on a process pool, skipping the ones whose csv is up to date.
+# Failed workbooks are logged to log_path and the rest carry on.
+def convert_workbooks(paths, cache=None, workers=1, log_path=None, logger=None):
+    transform = transform_key(VERSION)
+    todo = [p for p in paths if not (cache is not None and cache.fresh(p, transform))]
+    summary = map_files(csv_from_excel, todo, workers=workers, log_path=log_path, logger=logger)
+    if cache is not None:
+        for path, out in summary["ok"].items():
+            cache.record(path, transform, [out])
+        cache.save()
+    return summary
 
 
-def csv_from_excel(path):
+# Previous pandas implementation, loads the whole sheet in memory
+def csv_from_excel_pandas(path):
+    import pandas as pd
     df = pd.DataFrame(pd.read_excel(path, engine='openpyxl')).fillna(value = "NULL")
     df.to_csv(os.path.abspath(path).replace("xlsx","csv"), index=None, header=True)
 
@@ -39,9 +99,11 @@ def csv_from_excel(path):
 def main():
     args = arg()
     if args.automatic:
-        path = check_files()
+        scanner = ScanState(os.path.join(args.scan_state, "direkttest_csv.json"))
+        path = check_files(scanner)
         for p in path:
             csv_from_excel(p)
+        scanner.commit()
 
     else:
         path = args.filepath
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+# Mirror of the Eurofins FTP, replaces `lftp mirror`.
+# - Directory listings (MLSD) are cached. A directory whose modify time in
+#   its parent's listing is unchanged is not listed again, once it has
+#   settled: a file written in place doesn't change the modify time of its
+#   directory, so directories with files modified in the last settle
+#   seconds, or with files that failed to download, are listed every sync.
+# - Files are downloaded by a pool of threads, each with its own FTP
+#   connection, to a .part file that is resumed (REST) if interrupted.
+# - Completed files are appended to a manifest, so an interrupted sync
+#   continues where it left off and unchanged files are never downloaded again.
+# Host and port are configurable so it can run against a local FTP server.
+# Keep statedir outside dataloc, so the state files don't show up as changes
+# in the data tree.
+
+import calendar
+import ftplib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tools.atomic import read_json, write_json
+
+
+def connect(host, port, username, password, timeout=60):
+    ftp = ftplib.FTP()
+    ftp.connect(host, port, timeout=timeout)
+    ftp.login(username, password)
+    return ftp
+
+
+def remote_join(*parts):
+    return "/" + "/".join(p.strip("/") for p in parts if p.strip("/"))
+
+
+# MLSD modify fact (UTC) as a timestamp
+def timestamp(modify):
+    return calendar.timegm(time.strptime(modify[:14], "%Y%m%d%H%M%S"))
+
+
+# True if no file in the listing was modified in the last settle seconds
+def settled(entries, settle):
+    now = time.time()
+    return all(kind == "dir" or not modify or now - timestamp(modify) >= settle
+               for kind, size, modify in entries.values())
+
+
+# List the remote tree, returns {relative path: [size, modify]}
+def list_tree(ftp, cache, dirpath="/", modify=None, files=None, settle=3600):
+    if files is None:
+        files = {}
+    cached = cache.get(dirpath)
+    if modify is not None and cached and cached["modify"] == modify and cached.get("settled"):
+        entries = cached["entries"]
+        fresh = False
+    else:
+        entries = {}
+        for name, facts in ftp.mlsd(dirpath, facts=["type", "size", "modify"]):
+            if facts.get("type") in ("dir", "file"):
+                entries[name] = [facts["type"], int(facts.get("size", 0)), facts.get("modify")]
+        cache[dirpath] = {"modify": modify, "entries": entries, "settled": settled(entries, settle)}
+        fresh = True
+
+    for name, (kind, size, entry_modify) in sorted(entries.items()):
+        path = remote_join(dirpath, name)
+        if kind == "dir":
+            # Modify times in a cached listing may be stale, list those dirs again
+            list_tree(ftp, cache, path, entry_modify if fresh else None, files, settle)
+        else:
+            files[path.lstrip("/")] = [size, entry_modify]
+    return files
+
+
+def read_manifest(path):
+    manifest = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last line cut off by an interrupted run
+                    continue
+                manifest[record["path"]] = [record["size"], record["modify"]]
+    return manifest
+
+
+# settle: seconds since the last file change before a directory listing is reused
+def mirror(host, port, username, password, dataloc, logger, streams=4, statedir=None, retries=3, settle=3600):
+    statedir = statedir or dataloc
+    cache_path = os.path.join(statedir, ".mirror_listing.json")
+    manifest_path = os.path.join(statedir, ".mirror_manifest.jsonl")
+
+    ftp = connect(host, port, username, password)
+    cache = read_json(cache_path, {})
+    before = json.dumps(cache, sort_keys=True)
+    remote = list_tree(ftp, cache, settle=settle)
+    ftp.quit()
+
+    manifest = read_manifest(manifest_path)
+    todo = []
+    for relpath, record in remote.items():
+        local = os.path.join(dataloc, relpath)
+        if manifest.get(relpath) == record and os.path.isfile(local) and os.path.getsize(local) == record[0]:
+            continue
+        todo.append(relpath)
+    logger.info(f'{len(remote)} files on the FTP, {len(todo)} to download with {streams} streams.')
+
+    local_state = threading.local()
+    connections = []
+    lock = threading.Lock()
+    summary = {"downloaded": [], "failed": []}
+
+    def download(relpath):
+        size, modify = remote[relpath]
+        local = os.path.join(dataloc, relpath)
+        part = os.path.join(os.path.dirname(local), "." + os.path.basename(local) + ".part")
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+
+        for attempt in range(1, retries + 1):
+            try:
+                if getattr(local_state, "ftp", None) is None:
+                    local_state.ftp = connect(host, port, username, password)
+                    with lock:
+                        connections.append(local_state.ftp)
+                offset = os.path.getsize(part) if os.path.exists(part) else 0
+                if offset > size:
+                    offset = 0
+                with open(part, "ab" if offset else "wb") as f:
+                    local_state.ftp.retrbinary("RETR " + remote_join(relpath), f.write,
+                                               blocksize=1024 * 1024, rest=offset or None)
+                break
+            except (ftplib.Error, OSError, EOFError):
+                local_state.ftp = None
+                if attempt == retries:
+                    raise
+                time.sleep(2 ** attempt)
+
+        if os.path.getsize(part) != size:
+            raise IOError(f"size of {relpath} is {os.path.getsize(part)}, expected {size}")
+        os.replace(part, local)
+        if modify:
+            mtime = timestamp(modify)
+            os.utime(local, (mtime, mtime))
+
+        with lock:
+            with open(manifest_path, "a") as f:
+                f.write(json.dumps({"path": relpath, "size": size, "modify": modify}) + "\n")
+
+    with ThreadPoolExecutor(max_workers=max(1, streams)) as executor:
+        futures = {executor.submit(download, relpath): relpath for relpath in todo}
+        for n, future in enumerate(as_completed(futures), 1):
+            relpath = futures[future]
+            try:
+                future.result()
+                summary["downloaded"].append(relpath)
+                logger.info(f'[{n}/{len(todo)}] Downloaded {relpath} ({remote[relpath][0]} bytes).')
+            except Exception as e:
+                summary["failed"].append(relpath)
+                logger.error(f'[{n}/{len(todo)}] Download of {relpath} failed: {e}')
+
+    for conn in connections:
+        try:
+            conn.quit()
+        except (ftplib.Error, OSError, EOFError):
+            conn.close()
+
+    # The listing of a failed file may be stale (e.g. the file grew), list its directory again next sync
+    for relpath in summary["failed"]:
+        cached = cache.get(remote_join(os.path.dirname(relpath)))
+        if cached:
+            cached["settled"] = False
+    if json.dumps(cache, sort_keys=True) != before:
+        write_json(cache_path, cache)
+
+    return summary
@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+
+# Content hash of a file, read in large chunks.
+# The one file hashing helper of the pipeline: synced ledger, artifact cache,
+# md5sums check and GENSAM registry.
+
+import hashlib
+
+BUFSIZE = 1024 * 1024
+
+
+def file_digest(path, algorithm="sha256", bufsize=BUFSIZE):
+    digest = hashlib.new(algorithm)
+    # Unbuffered, every read is one large read of the file
+    with open(path, "rb", buffering=0) as f:
+        for data in iter(lambda: f.read(bufsize), b""):
+            digest.update(data)
+    return digest.hexdigest()
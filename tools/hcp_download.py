@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# Parallel download of objects from the HCP.
+# Objects are downloaded by a pool of threads, large objects with ranged
+# GETs in parallel. Files already in the output dir with the same size and
+# ETag are skipped. Data is written to a temp file that is renamed into
+# place when complete, so partial files never show up under the real name.
+
+import hashlib
+import math
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tools.hcp_multipart import MB
+
+READ_SIZE = 8 * MB
+
+
+def file_md5(path, start=0, length=None):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = length
+        while remaining is None or remaining > 0:
+            data = f.read(READ_SIZE if remaining is None else min(READ_SIZE, remaining))
+            if not data:
+                break
+            md5.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return md5
+
+
+# ETag of a local file as the HCP would compute it. Multipart ETags are
+# md5 of the part md5s plus "-<parts>", the part size is not stored so the
+# usual part sizes are tried.
+def matches_etag(path, size, etag):
+    if "-" not in etag:
+        return file_md5(path).hexdigest() == etag
+
+    nparts = int(etag.split("-")[1])
+    for part_size in (8 * MB, 16 * MB, 32 * MB, 64 * MB, 128 * MB, 256 * MB, 512 * MB):
+        if math.ceil(size / part_size) != nparts:
+            continue
+        digests = b"".join(file_md5(path, (n - 1) * part_size, part_size).digest() for n in range(1, nparts + 1))
+        if hashlib.md5(digests).hexdigest() + "-" + str(nparts) == etag:
+            return True
+    return False
+
+
+def is_current(path, size, etag):
+    return os.path.isfile(path) and os.path.getsize(path) == size and matches_etag(path, size, etag)
+
+
+def download_object(client, bucket, key, target, size, chunk_size=64 * MB, part_workers=4):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(target)),
+                               prefix="." + os.path.basename(target) + ".", suffix=".part")
+    try:
+        os.ftruncate(fd, size)
+
+        def fetch(start):
+            end = min(start + chunk_size, size) - 1
+            body = client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}")["Body"]
+            offset = start
+            for data in body.iter_chunks(READ_SIZE):
+                os.pwrite(fd, data, offset)
+                offset += len(data)
+
+        # Ranged GETs in parallel for large objects, one GET otherwise
+        starts = range(0, size, chunk_size)
+        if len(starts) > 1:
+            with ThreadPoolExecutor(max_workers=max(1, part_workers)) as executor:
+                list(executor.map(fetch, starts))
+        elif size > 0:
+            fetch(0)
+
+        os.fsync(fd)
+        os.close(fd)
+        fd = None
+        os.replace(tmp, target)
+    except BaseException:
+        if fd is not None:
+            os.close(fd)
+        os.remove(tmp)
+        raise
+
+
+def download_objects(hcpm, keys, output, logger, workers=4, part_workers=4, chunk_size=64 * MB):
+    client = hcpm.bucket.meta.client
+    bucket = hcpm.bucket.name
+    summary = {"downloaded": [], "skipped": [], "failed": []}
+
+    def download(key):
+        head = client.head_object(Bucket=bucket, Key=key)
+        size = head["ContentLength"]
+        etag = head["ETag"].strip('"')
+        target = os.path.join(output, os.path.basename(key))
+        if is_current(target, size, etag):
+            return False
+        download_object(client, bucket, key, target, size, chunk_size, part_workers)
+        return True
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(download, key): key for key in keys}
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                if future.result():
+                    logger.info(f"downloaded: {key}")
+                    summary["downloaded"].append(key)
+                else:
+                    logger.info(f"Skipping {key}, identical file already in {output}")
+                    summary["skipped"].append(key)
+            except Exception as e:
+                logger.error(f"Download of {key} failed: {e}")
+                summary["failed"].append(key)
+
+    logger.info(f"Download summary: {len(summary['downloaded'])} downloaded, "
+                f"{len(summary['skipped'])} already present, {len(summary['failed'])} failed")
+    return summary
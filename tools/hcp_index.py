@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# Existence index of the objects on the HCP.
+# Built from one prefix listing of the bucket (key, size, ETag) so checking
+# if a file is already uploaded is a dict lookup instead of a remote search.
+# The index can be cached on disk with a TTL so back-to-back cron runs
+# don't re-list the whole bucket.
+
+import os
+import time
+from tools.atomic import read_json, write_json, locked
+
+
+def build_index(hcpm, prefix="covid-wgs/", cache=None, ttl=3600):
+    # Use the cached listing if it is for the same bucket and young enough
+    if cache:
+        cached = read_json(cache)
+        if (cached and cached.get("bucket") == hcpm.bucket.name and cached.get("prefix") == prefix
+                and time.time() - cached.get("created", 0) < ttl):
+            return cached["objects"]
+
+    started = time.time()
+    objects = {}
+    for obj in hcpm.bucket.objects.filter(Prefix=prefix):
+        objects[obj.key] = {"size": obj.size, "etag": obj.e_tag.strip('"')}
+
+    if cache:
+        os.makedirs(os.path.dirname(os.path.abspath(cache)), exist_ok=True)
+        # Same lock as update_cache. Uploads another wrapper added while the
+        # bucket was listed may be missing from the listing, keep them.
+        with locked(cache):
+            cached = read_json(cache)
+            if cached and cached.get("bucket") == hcpm.bucket.name and cached.get("prefix") == prefix:
+                for key, record in cached["objects"].items():
+                    if key not in objects and record.get("added", 0) >= started:
+                        objects[key] = record
+            write_json(cache, {"bucket": hcpm.bucket.name, "prefix": prefix,
+                               "created": started, "objects": objects})
+    return objects
+
+
+# Add uploaded files to a cached index, so the next run within the TTL
+# doesn't upload them again. Locked, the wrappers share the index of a bucket.
+def update_cache(cache, uploaded, prefix="covid-wgs/"):
+    if not uploaded:
+        return
+    with locked(cache):
+        cached = read_json(cache)
+        if not cached:
+            return
+        for path in uploaded:
+            cached["objects"][prefix + os.path.basename(path)] = {"size": os.path.getsize(path), "etag": None,
+                                                                  "added": time.time()}
+        write_json(cache, cached)
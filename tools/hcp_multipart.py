@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Resumable multipart upload of large files (fastq.gz) to the HCP.
+# The file is sent in parts of chunk_size bytes, at most `workers` parts at
+# a time, so memory use is bounded by workers * chunk_size.
+# The upload id is kept in a state file. If the upload is interrupted, the
+# next call lists the parts already on the HCP and only sends the missing ones.
+
+import hashlib
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from tools.atomic import read_json, write_json
+
+MB = 1024 * 1024
+
+
+def state_path(state_dir, path, key):
+    name = hashlib.md5((os.path.abspath(path) + "|" + key).encode()).hexdigest()
+    return os.path.join(state_dir, name + ".json")
+
+
+def uploaded_parts(client, bucket, key, upload_id):
+    parts = {}
+    kwargs = {"Bucket": bucket, "Key": key, "UploadId": upload_id}
+    while True:
+        response = client.list_parts(**kwargs)
+        for part in response.get("Parts", []):
+            parts[part["PartNumber"]] = {"ETag": part["ETag"], "Size": part["Size"]}
+        if not response.get("IsTruncated"):
+            return parts
+        kwargs["PartNumberMarker"] = response["NextPartNumberMarker"]
+
+
+def read_part(path, number, chunk_size):
+    with open(path, "rb") as f:
+        f.seek((number - 1) * chunk_size)
+        return f.read(chunk_size)
+
+
+def multipart_upload(hcpm, path, key, state_dir, chunk_size=64 * MB, workers=4, logger=None):
+    client = hcpm.bucket.meta.client
+    bucket = hcpm.bucket.name
+    st = os.stat(path)
+    nparts = max(1, math.ceil(st.st_size / chunk_size))
+
+    # Resume if there is a state file for the same, unchanged file
+    os.makedirs(state_dir, exist_ok=True)
+    state_file = state_path(state_dir, path, key)
+    state = read_json(state_file)
+    done = {}
+    if state and state["size"] == st.st_size and state["mtime"] == st.st_mtime and state["chunk_size"] == chunk_size:
+        try:
+            done = uploaded_parts(client, bucket, key, state["upload_id"])
+            if logger:
+                logger.info(f"Resuming upload of {path}, {len(done)}/{nparts} parts already on HCP")
+        except client.exceptions.NoSuchUpload:
+            state = None
+    else:
+        state = None
+
+    if state is None:
+        upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+        state = {"path": os.path.abspath(path), "key": key, "size": st.st_size, "mtime": st.st_mtime,
+                 "chunk_size": chunk_size, "upload_id": upload_id}
+        write_json(state_file, state)
+
+    # Only keep parts of the expected size, a short part is sent again
+    etags = {}
+    for number, part in done.items():
+        expected = min(chunk_size, st.st_size - (number - 1) * chunk_size)
+        if part["Size"] == expected:
+            etags[number] = part["ETag"]
+
+    def send(number):
+        response = client.upload_part(Bucket=bucket, Key=key, PartNumber=number,
+                                      UploadId=state["upload_id"], Body=read_part(path, number, chunk_size))
+        return number, response["ETag"]
+
+    missing = [n for n in range(1, nparts + 1) if n not in etags]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for number, etag in executor.map(send, missing):
+            etags[number] = etag
+
+    client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=state["upload_id"],
+                                     MultipartUpload={"Parts": [{"ETag": etags[n], "PartNumber": n}
+                                                                for n in sorted(etags)]})
+    os.remove(state_file)
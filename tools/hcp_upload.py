@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Parallel upload of files to the HCP.
+# Files already in the existence index are skipped, the rest are uploaded by
+# a bounded pool of threads sharing one HCPManager, each file is retried
+# with exponential backoff and a summary of successes and failures is
+# logged at the end.
+# Works against any S3 compatible endpoint (-ep), e.g. a local MinIO for testing.
+# upload_stage and run_pipeline are the parts the cron wrappers share.
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tools.hcp_index import build_index, update_cache
+from tools.run_state import RunState
+from tools.stages import OK, DONE, summary as stage_summary
+
+
+def upload_one(hcpm, path, key, retries=3, backoff=2, upload=None):
+    for attempt in range(1, retries + 1):
+        try:
+            if upload:
+                upload(hcpm, path, key)
+            else:
+                hcpm.upload_file(path, key)
+            return attempt
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+
+# index: existence index from tools.hcp_index, files whose key is in it are skipped.
+# None uploads everything.
+# upload: function(hcpm, path, key) used instead of hcpm.upload_file, e.g. for multipart uploads.
+def upload_files(hcpm, files, logger, workers=4, retries=3, backoff=2, prefix="covid-wgs/", index=None, upload=None):
+    summary = {"uploaded": [], "existing": [], "failed": []}
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {}
+        for path in files:
+            # Existence is checked before submitting, only new files go to the pool
+            key = prefix + os.path.basename(path)
+            if index is not None and key in index:
+                logger.error(f"Object already exists {path}")
+                summary["existing"].append(path)
+                continue
+            futures[executor.submit(upload_one, hcpm, path, key, retries, backoff, upload)] = path
+
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                attempts = future.result()
+                logger.info(f"uploading: {path}" + (f" (attempt {attempts})" if attempts > 1 else ""))
+                summary["uploaded"].append(path)
+                if index is not None:
+                    index[prefix + os.path.basename(path)] = {"size": os.path.getsize(path), "etag": None}
+            except Exception as e:
+                logger.error(f"Upload of {path} failed after {retries} attempts: {e}")
+                summary["failed"].append(path)
+
+    logger.info(f"Upload summary: {len(summary['uploaded'])} uploaded, "
+                f"{len(summary['existing'])} already existing, {len(summary['failed'])} failed")
+    for path in summary["failed"]:
+        logger.error(f"Failed upload: {path}")
+
+    return summary
+
+
+# HCP upload stage of a wrapper: one listing of the bucket, the upload of the
+# new files and the update of the cached listing.
+# args: wrapper arguments (endpoint, keys, bucket, index_cache, index_ttl, workers, retries)
+# hcpm: connected HCPManager to reuse, None connects when there is something to upload
+# Raises IOError if a file failed, so the stage fails.
+def upload_stage(args, files, logger, hcpm=None):
+    if not files:
+        logger.info("No new files to upload")
+        return None
+    if hcpm is None:
+        # boto3 is only loaded when there is something to upload
+        from NGPinterface.hcp import HCPManager
+        hcpm = HCPManager(args.endpoint, args.aws_access_key_id, args.aws_secret_access_key)
+        hcpm.attach_bucket(args.bucket)
+
+    # One listing of the bucket instead of a search per file
+    cache = os.path.join(args.index_cache, args.bucket + "_index.json")
+    index = build_index(hcpm, cache=cache, ttl=args.index_ttl)
+    summary = upload_files(hcpm, files, logger, workers=args.workers, retries=args.retries, index=index)
+    update_cache(cache, summary["uploaded"])
+    if summary["failed"]:
+        raise IOError(f'HCP upload failed for {len(summary["failed"])} files')
+    return None
+
+
+# Run the stages of a wrapper with the run state in scan_state and commit the
+# scanner once every stage completed. A failed run keeps the scan state, so
+# the next run sees the same files again.
+# logger: logger of the wrapper, the stage summary goes to its log file
+# Returns False if a stage failed, None if files were left for the next run
+def run_pipeline(graph, scanner, scan_state, run, logger, workers=4):
+    os.makedirs(scan_state, exist_ok=True)
+    state = RunState(os.path.join(scan_state, "run_state.db"))
+    try:
+        results = graph.run(workers=workers, state=state, run=run)
+    finally:
+        state.close()
+    logger.info(stage_summary(results))
+
+    complete = all(result["status"] in (OK, DONE) for result in results.values())
+    if complete:
+        scanner.commit()
+    return None if complete and scanner.deferred else complete
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# In-process check of md5sums.txt files, replaces `md5sum -c`.
+# Files are hashed across a process pool with large read buffers and every
+# mismatch is reported, not only the first. Digests are cached per
+# (path, size, mtime) so unchanged files are never hashed again.
+# The pool starts its workers from a forkserver, the sync runs in a stage
+# thread of the eurofins wrapper and forking a multi-threaded process can
+# copy a held lock into the child.
+#
+#   python -m tools.md5verify path/to/md5sums.txt [...] -c md5_cache.json
+
+import argparse
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from tools.atomic import read_json, write_json
+from tools.hashing import file_digest
+
+BUFSIZE = 16 * 1024 * 1024
+
+
+def arg():
+    parser = argparse.ArgumentParser(prog="md5verify.py")
+    parser.add_argument("md5files", nargs="+", help="md5sums.txt files to check")
+    parser.add_argument("-c", "--cache", help="digest cache file")
+    parser.add_argument("-w", "--workers", type=int, help="number of hashing processes, default one per cpu")
+    args = parser.parse_args()
+    return args
+
+
+# Lines are "<md5>  <file>", "*<file>" in binary mode, relative to the md5sums.txt
+def parse_md5sums(md5file):
+    md5dir = os.path.dirname(os.path.abspath(md5file))
+    entries = []
+    with open(md5file) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+            digest, name = line.split(None, 1)
+            if name.startswith("*"):
+                name = name[1:]
+            entries.append((digest.lower(), os.path.join(md5dir, name)))
+    return entries
+
+
+def md5_file(path):
+    return file_digest(path, "md5", BUFSIZE)
+
+
+# Returns a list of (path, expected, found), found is None for missing files
+def verify_md5sums(md5files, cache=None, workers=None):
+    cached = read_json(cache, {}) if cache else {}
+    expected = []
+    for md5file in md5files:
+        expected.extend(parse_md5sums(md5file))
+
+    mismatches = []
+    digests = {}
+    to_hash = []
+    for digest, path in expected:
+        try:
+            st = os.stat(path)
+        except OSError:
+            mismatches.append((path, digest, None))
+            continue
+        hit = cached.get(path)
+        if hit and hit[0] == st.st_size and hit[1] == st.st_mtime:
+            digests[path] = hit[2]
+        else:
+            to_hash.append((path, st))
+
+    # Biggest files first so one large file doesn't end up last on its own
+    to_hash.sort(key=lambda item: item[1].st_size, reverse=True)
+    if to_hash:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context("forkserver")) as executor:
+            paths = [path for path, st in to_hash]
+            for (path, st), digest in zip(to_hash, executor.map(md5_file, paths)):
+                digests[path] = digest
+                cached[path] = [st.st_size, st.st_mtime, digest]
+
+    for digest, path in expected:
+        if path in digests and digests[path] != digest:
+            mismatches.append((path, digest, digests[path]))
+
+    if cache and to_hash:
+        write_json(cache, cached)
+
+    return mismatches
+
+
+def main():
+    args = arg()
+    mismatches = verify_md5sums(args.md5files, args.cache, args.workers)
+    for path, expected, found in mismatches:
+        print(f"{path}: {'MISSING' if found is None else 'FAILED'}", file=sys.stderr)
+    if mismatches:
+        sys.exit(f"ERROR: {len(mismatches)} file(s) failed the md5 check")
+
+
+if __name__ == "__main__":
+    main()
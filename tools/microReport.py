@@ -2,36 +2,94 @@
 
 import datetime
 import os
-import click
 import glob
-from shutil import copy
+import shutil
+import fcntl
+from tools.synced_ledger import open_ledger
+from tools.hashing import file_digest
+
+FICLONE = 0x40049409 # Linux ioctl for reflinks (btrfs, xfs)
+
+
+# Reflink copy, shares the data blocks but is an independent file
+def reflink(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+# Put src in place as dst without copying data when possible:
+# reflink, then hardlink (if allowed) when on the same filesystem, else a
+# streamed copy. Written to a temp name first so the outbox never has
+# partial files. A hardlink shares the inode, so it is only safe if src is
+# replaced and never rewritten in place.
+def place(src, dst, hardlink=False):
+    tmp = os.path.join(os.path.dirname(dst), "." + os.path.basename(dst) + ".tmp")
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+
+    placed = False
+    if os.stat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev:
+        for link in (reflink, os.link) if hardlink else (reflink,):
+            try:
+                link(src, tmp)
+                placed = True
+                break
+            except OSError:
+                if os.path.lexists(tmp):
+                    os.remove(tmp)
+
+    if not placed:
+        with open(src, "rb") as fsrc, open(tmp, "wb") as fdst:
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+        shutil.copymode(src, tmp)
+
+    os.replace(tmp, dst)
+
+
+# Copy new or changed files to the outbox and record them in the ledger.
+# A file is only hashed when its size or mtime changed, and only re-sent
+# when its content hash changed. Content that is already in the outbox
+# under another name is linked from there (outbox files are only ever
+# replaced, so hardlinks between them are safe).
+def sync_files(file_list, syncdir, ledger, log, hardlink=False):
+    for sync_path in file_list:
+        sync_base = os.path.basename(sync_path)
+        st = os.stat(sync_path)
+        record = ledger.get(sync_base)
+        if record and record["size"] == st.st_size and record["mtime"] == st.st_mtime:
+            continue
+
+        digest = file_digest(sync_path)
+        # Same content as last time (or synced before hashes were recorded)
+        if record and record["sha256"] in (digest, None):
+            ledger.add(sync_base, digest, sync_path, st.st_size, st.st_mtime)
+            continue
+
+        src, link = sync_path, hardlink
+        for name in ledger.names_with_digest(digest):
+            if os.path.isfile(os.path.join(syncdir, name)):
+                src, link = os.path.join(syncdir, name), True
+                break
+
+        log.write("** LOG: Copying " + sync_base + " to " + syncdir + ".\n")
+        place(src, os.path.join(syncdir, sync_base), link)
+        ledger.add(sync_base, digest, sync_path, st.st_size, st.st_mtime)
+
 
-def eurofins(eurofinsdir, syncdir, syncedfiles, logfile):
+def eurofins(eurofinsdir, syncdir, syncedfiles, logfile, hardlink=False):
     log = open(logfile, "a")
     now = datetime.datetime.now()
     log.write("** LOG: Starting sync of pangolin files to microbiology outbox @ "
               + now.strftime("%Y-%m-%d %H:%M:%S") + "\n")
 
-    # Read in already copied files
-    with open(syncedfiles) as sync_file:
-        synced = sync_file.read().splitlines()
+    # Ledger of already copied files
+    ledger = open_ledger(syncedfiles)
 
     # Find all pangolin files in the Eurofins folder
     pangolin_list = glob.glob(eurofinsdir + "/*/*_pangolin_lineage_classification_fillempty.txt")
 
-    # Add the synced files to the list
-    f = open(syncedfiles, "a")
-    for pangolin_file in pangolin_list:
-        pangolin_base = os.path.basename(pangolin_file)
-        # Have the file already been copied over at some point?
-        if pangolin_base not in synced:
-            log.write("** LOG: Copying " + pangolin_base + " to " + syncdir + ".\n")
-            copy(pangolin_file, syncdir)
-            f.write(pangolin_base + "\n")
-        else:
-            continue
-
-    f.close()
+    sync_files(pangolin_list, syncdir, ledger, log, hardlink)
+    ledger.close()
 
     # Write an end to the log
     now = datetime.datetime.now()
@@ -40,15 +98,14 @@ def eurofins(eurofinsdir, syncdir, syncedfiles, logfile):
     log.close()
 
 
-def nextseq(nextseqdir, articdir, syncdir, syncedfiles, logfile):
+def nextseq(nextseqdir, articdir, syncdir, syncedfiles, logfile, hardlink=False):
     log = open(logfile, "a")
     now = datetime.datetime.now()
     log.write("** LOG: Starting sync of pangolin files to microbiology outbox @ "
               + now.strftime("%Y-%m-%d %H:%M:%S") + "\n")
 
-    # Read in already copied files
-    with open(syncedfiles) as sync_file:
-        synced = sync_file.read().splitlines()
+    # Ledger of already copied files
+    ledger = open_ledger(syncedfiles)
 
     # Find all pangolin files in the Eurofins folder
     pangolin_list = glob.glob(nextseqdir + "/*/lineage/*_lineage_report_fillempty.txt")
@@ -56,33 +113,9 @@ def nextseq(nextseqdir, articdir, syncdir, syncedfiles, logfile):
     # Find all pangolin files in the Eurofins folder
     artic_list = glob.glob(articdir + "/*/*.qc.csv")
 
-    # Add the synced files to the list
-    f = open(syncedfiles, "a")
-    for pangolin_file in pangolin_list:
-        pangolin_base = os.path.basename(pangolin_file)
-        # Have the file already been copied over at some point?
-        if pangolin_base not in synced:
-            log.write("** LOG: Copying " + pangolin_base + " to " + syncdir + ".\n")
-            copy(pangolin_file, syncdir)
-            f.write(pangolin_base + "\n")
-        else:
-            continue
-
-    f.close()
-
-    # Add the synced artic files to the list
-    fa = open(syncedfiles, "a")
-    for artic_file in artic_list:
-        artic_base = os.path.basename(artic_file)
-        # Have the file already been copied over at some point?
-        if artic_base not in synced:
-            log.write("** LOG: Copying " + artic_base + " to " + syncdir + ".\n")
-            copy(artic_file, syncdir)
-            fa.write(artic_base + "\n")
-        else:
-            continue
-
-    fa.close()
+    sync_files(pangolin_list, syncdir, ledger, log, hardlink)
+    sync_files(artic_list, syncdir, ledger, log, hardlink)
+    ledger.close()
     
     # Write an end to the log
     now = datetime.datetime.now()
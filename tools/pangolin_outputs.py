@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# Post-processing of pangolin result files.
+# Each report is read once, the taxon rewrite is done once and every output
+# variant for that data source is written from the same frame.
+# To add a new variant, add an entry to "outputs" of the source.
+# With an ArtifactCache, reports that haven't changed since their outputs
+# were written are skipped. Outputs are written atomically.
+
+import fnmatch
+import functools
+import os
+from tools.taxon import normalise_taxon
+from tools.atomic import atomic_write
+from tools.artifact_cache import transform_key
+from tools.parallel import map_files
+
+# Bump when the conversion changes in a way not visible in the source settings
+VERSION = 1
+
+# suffix:     replaces ".txt" in the input file name
+# fillna:     value for empty cells, None keeps them empty
+# run_prefix: prefix the output name with the run directory name
+NEXTSEQ = {
+    "pattern": "*_lineage_report.txt",
+    "sep": ",",
+    "taxon": True,
+    "outputs": [
+        # GENSAM, tab sep output without NULL
+        {"suffix": "_gensam.txt", "sep": "\t", "fillna": None, "run_prefix": True},
+        # HCP, tab sep output with NULL
+        {"suffix": "_fillempty.txt", "sep": "\t", "fillna": "NULL", "run_prefix": True},
+    ],
+}
+
+EUROFINS = {
+    "pattern": "*_pangolin_lineage_classification.txt",
+    "sep": "\t",
+    "taxon": False,
+    "outputs": [
+        # HCP, tab sep output with NULL
+        {"suffix": "_fillempty.txt", "sep": "\t", "fillna": "NULL", "run_prefix": False},
+    ],
+}
+
+
+def output_path(path, output):
+    name = os.path.basename(path).replace(".txt", output["suffix"])
+    if output["run_prefix"]:
+        name = os.path.basename(os.path.dirname(path)) + "_" + name
+    return os.path.join(os.path.dirname(os.path.abspath(path)), name)
+
+
+# Write every output variant of one report, returns the output paths
+def convert(f, source):
+    # pandas is only loaded when there is a report to convert
+    import pandas as pd
+
+    print("updating: " + f)
+    df = pd.read_csv(f, sep=source["sep"])
+    if source["taxon"]:
+        df = normalise_taxon(df) # change taxon names
+
+    outputs = []
+    for output in source["outputs"]:
+        out = df if output["fillna"] is None else df.fillna(value=output["fillna"])
+        out_path = output_path(f, output)
+        with atomic_write(out_path) as fh:
+            out.to_csv(fh, index=None, header=True, sep=output["sep"])
+        outputs.append(out_path)
+    return outputs
+
+
+# cache: ArtifactCache, None always converts
+# workers: processes converting reports in parallel, failed reports are logged to log_path
+# logger: logger of the wrapper for the conversion summary
+# Returns the map_files summary, "ok" has the output paths of each report
+def postprocess(path_list, source, cache=None, workers=1, log_path=None, logger=None):
+    transform = transform_key(VERSION, source)
+    todo = [f for f in path_list
+            if fnmatch.fnmatch(os.path.basename(f), source["pattern"])
+            and not (cache is not None and cache.fresh(f, transform))]
+
+    summary = map_files(functools.partial(convert, source=source), todo,
+                        workers=workers, log_path=log_path, name="pangolin", logger=logger)
+
+    if cache is not None:
+        for f, outputs in summary["ok"].items():
+            cache.record(f, transform, outputs)
+        cache.save()
+
+    return summary
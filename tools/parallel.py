@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# Parallel map stage for the per-file transforms of the cron wrappers
+# (pangolin outputs, xlsx conversion, samplesheet parsing).
+# Files are spread over a process pool. Like @log.log_error a failing file
+# is logged and the other files carry on. Returns a summary of the files
+# that were converted and the ones that failed.
+# The wrappers call this from stage threads, so the workers are started by
+# a forkserver instead of forking the multi-threaded wrapper (a fork can copy
+# locks held by the other threads, e.g. logging or HCP client locks).
+
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+# One logger and file handler per error log, also when the watcher maps files many times
+def error_logger(log_path):
+    logger = logging.getLogger("parallel:" + log_path)
+    if not logger.handlers:
+        logger.setLevel(logging.ERROR)
+        file_handler = logging.FileHandler(log_path)
+        file_handler.setFormatter(logging.Formatter('%(levelname)s %(asctime)s %(message)s'))
+        logger.addHandler(file_handler)
+        logger.propagate = False
+    return logger
+
+
+# func: module level function (it is pickled to the workers) taking a path
+# log_path: error log of the wrapper, None logs the errors to logger
+# logger: logger of the wrapper for the summary, None is the "parallel" logger
+def map_files(func, paths, workers=4, log_path=None, name=None, logger=None):
+    # functools.partial has the function in .func
+    name = name or getattr(getattr(func, "func", func), "__name__", "map_files")
+    summary = {"ok": {}, "failed": {}}
+    if not paths:
+        return summary
+
+    logger = logger or logging.getLogger("parallel")
+
+    def failed(path, e):
+        (error_logger(log_path) if log_path else logger).exception('And error has occurred at /' + name + ' for ' + path + '\n')
+        summary["failed"][path] = e
+
+    if workers <= 1 or len(paths) <= 1:
+        for path in paths:
+            try:
+                summary["ok"][path] = func(path)
+            except Exception as e:
+                failed(path, e)
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(paths)),
+                                 mp_context=multiprocessing.get_context("forkserver")) as executor:
+            futures = {executor.submit(func, path): path for path in paths}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    summary["ok"][path] = future.result()
+                except Exception as e:
+                    failed(path, e)
+
+    logger.info(f"{name}: {len(summary['ok'])} ok, {len(summary['failed'])} failed")
+    for path, e in sorted(summary["failed"].items()):
+        logger.error(f"{name} failed for {path}: {e}")
+    return summary
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Readiness of data that may still be being written.
+# check_files and the scanner only look at ctime/mtime, so a run can be
+# picked up halfway through a copy. These checks decide which files are
+# settled and can go to the upload stages, the rest is deferred to the
+# next run.
+#   NextSeq:  the run directory has a marker file, or the sizes and mtimes
+#             of all its files were the same in the last N scans.
+#   Eurofins: md5sums.txt of the date directory is complete and every file
+#             it lists has been mirrored (no .part file left).
+#   Files:    not modified in the last min_age seconds.
+
+import hashlib
+import os
+import time
+from tools.atomic import read_json, write_json
+from tools.md5verify import parse_md5sums
+
+
+# Split paths in files not modified for min_age seconds and files still changing
+def settled_files(paths, min_age=300):
+    now = time.time()
+    ready, waiting = [], []
+    for path in paths:
+        try:
+            settled = now - os.stat(path).st_mtime >= min_age
+        except OSError:
+            # Removed since the scan
+            continue
+        (ready if settled else waiting).append(path)
+    return ready, waiting
+
+
+def tree_signature(dirpath):
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(dirpath):
+        dirs.sort()
+        for name in sorted(files):
+            try:
+                st = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            digest.update(f"{os.path.join(root, name)}\0{st.st_size}\0{st.st_mtime}\n".encode())
+    return digest.hexdigest()
+
+
+# Number of consecutive scans a directory tree looked the same, kept in a JSON file
+class StableTracker:
+    def __init__(self, path):
+        self.path = path
+        self.state = read_json(path, {})
+
+    def stable(self, dirpath, scans=2):
+        signature = tree_signature(dirpath)
+        record = self.state.get(dirpath)
+        if record and record["signature"] == signature:
+            record["count"] += 1
+        else:
+            record = self.state[dirpath] = {"signature": signature, "count": 1}
+        return record["count"] >= scans
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        write_json(self.path, self.state)
+
+
+def nextseq_ready(rundir, tracker, marker=None, scans=2):
+    if marker and os.path.exists(os.path.join(rundir, marker)):
+        return True
+    return tracker.stable(rundir, scans)
+
+
+def md5sums_complete(dirpath):
+    md5file = os.path.join(dirpath, "md5sums.txt")
+    try:
+        with open(md5file, "rb") as f:
+            data = f.read()
+        # A file still being written usually stops mid line
+        if not data.endswith(b"\n"):
+            return False
+        entries = parse_md5sums(md5file)
+    except (OSError, ValueError):
+        return False
+    for digest, path in entries:
+        part = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".part")
+        if not os.path.exists(path) or os.path.exists(part):
+            return False
+    return bool(entries)
+
+
+# Split eurofins paths in files of complete date directories and the rest
+def eurofins_ready(paths):
+    complete = {}
+    ready, waiting = [], []
+    for path in paths:
+        dirpath = os.path.dirname(path)
+        if dirpath not in complete:
+            complete[dirpath] = md5sums_complete(dirpath)
+        (ready if complete[dirpath] else waiting).append(path)
+    return ready, waiting
+
+
+# Ready files of a scan, the others are deferred so the scanner returns them again.
+# split: settled_files, eurofins_ready or another function returning (ready, waiting)
+def take_ready(scanner, paths, split, logger=None):
+    ready, waiting = split(paths)
+    if waiting:
+        scanner.defer(waiting)
+        if logger:
+            logger.info(f'{len(waiting)} file(s) still being written, deferred to the next run')
+    return ready
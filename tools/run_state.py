@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Per-run stage state of the cron wrappers.
+# An SQLite database keyed by (run, stage). Each record has the status of
+# the last attempt, the fingerprint of the stage inputs, the outputs it
+# wrote and when it finished. A rerun of the same run looks up each stage
+# by key and skips it when it completed with the same fingerprint and its
+# outputs still exist. WAL mode and a lock timeout let the nextseq,
+# eurofins and direkttest wrappers share one database.
+#
+# Show the stages of a run:
+#   python -m tools.run_state -d run_state.db nextseq/<runid>
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+FIELDS = ("run", "stage", "status", "fingerprint", "outputs", "finished_at", "seconds")
+
+
+# Fingerprint of input files from their path, size and mtime
+def fingerprint(paths):
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        try:
+            st = os.stat(path)
+            digest.update(f"{path}\0{st.st_size}\0{st.st_mtime}\n".encode())
+        except OSError:
+            digest.update(f"{path}\0missing\n".encode())
+    return digest.hexdigest()
+
+
+class RunState:
+    def __init__(self, path, timeout=60):
+        self.path = path
+        # Stages record their state from the runner threads
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS stages ("
+                          "run TEXT, stage TEXT, status TEXT, fingerprint TEXT, outputs TEXT, "
+                          "finished_at TEXT, seconds REAL, PRIMARY KEY (run, stage))")
+
+    def _record(self, row):
+        record = dict(zip(FIELDS, row))
+        record["outputs"] = json.loads(record["outputs"]) if record["outputs"] else []
+        return record
+
+    def get(self, run, stage):
+        with self.lock:
+            row = self.conn.execute(f"SELECT {', '.join(FIELDS)} FROM stages WHERE run = ? AND stage = ?",
+                                    (run, stage)).fetchone()
+        return self._record(row) if row else None
+
+    def stages(self, run):
+        with self.lock:
+            rows = self.conn.execute(f"SELECT {', '.join(FIELDS)} FROM stages WHERE run = ? ORDER BY finished_at",
+                                     (run,)).fetchall()
+        return [self._record(row) for row in rows]
+
+    # True if the stage completed with this fingerprint and its outputs are still there
+    def complete(self, run, stage, fingerprint=None):
+        record = self.get(run, stage)
+        return (record is not None and record["status"] == "ok" and record["fingerprint"] == fingerprint
+                and all(os.path.exists(out) for out in record["outputs"]))
+
+    def set(self, run, stage, status, fingerprint=None, outputs=(), seconds=None):
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (run, stage, status, fingerprint, json.dumps(list(outputs)), now, seconds))
+
+    def close(self):
+        self.conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="run_state.py")
+    parser.add_argument("-d", "--database", required=True, help="path to the run state database")
+    parser.add_argument("run", help="run key, e.g. nextseq/<runid>, eurofins or direkttest")
+    args = parser.parse_args()
+
+    state = RunState(args.database)
+    for record in state.stages(args.run):
+        print(f'{record["stage"]:<20} {record["status"]:<8} {record["seconds"] or 0:8.1f} {record["finished_at"]}')
+
+
+if __name__ == "__main__":
+    main()
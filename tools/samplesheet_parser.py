@@ -3,7 +3,6 @@
 # Parse covid samplesheet run by nextseq
 # outputs a json file
 
-from sample_sheet import SampleSheet
 import json
 import argparse
 import os
@@ -19,6 +18,7 @@ def arg():
 
 # Parse input samplesheet
 def sample_sheet(path,run):
+    from sample_sheet import SampleSheet
     Sheet = SampleSheet(path)
     data = {}
     for sample in Sheet.samples:
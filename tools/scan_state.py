@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+# Incremental file scanner, replaces the ctime-window globbing of check_files.
+# For every glob pattern the state file keeps the mtime and matching entries
+# of each directory and the inode, size and mtime of each matching file.
+# A scan only lists directories whose mtime changed since the previous run
+# and returns exactly the files that are new or changed. A file rewritten in
+# place doesn't change the mtime of its directory, so the files of the last
+# level are stat'ed until the directory has settled: neither it, nor its
+# files or subdirectories were modified in the last settle seconds. A
+# settled directory whose mtime is unchanged is not looked at again, its
+# whole subtree is taken from the state. A file added deeper down doesn't
+# change that mtime, so every directory is listed again once per sweep
+# seconds, or with full=True. State is written with commit(), after the
+# caller has processed the files successfully, so a failed or skipped run
+# doesn't lose anything.
+
+import datetime as dt
+import fnmatch
+import os
+import re
+import time
+from tools.atomic import read_json, write_json
+
+MAGIC = re.compile("[*?[]")
+
+
+class ScanState:
+    def __init__(self, path):
+        self.path = path
+        self.state = read_json(path, {})
+        self.pending = {}
+        self.deferred = set()
+
+    # first_window: minutes of ctime window used the first time a pattern is scanned,
+    # so a new state file doesn't return the whole tree
+    # settle: seconds without modification before a directory is no longer checked
+    # sweep: seconds between scans that list every directory
+    def scan(self, pattern, full=False, first_window=720, settle=86400, sweep=86400):
+        first = pattern not in self.state
+        old = self.state.get(pattern, {"dirs": {}, "files": {}})
+        now = time.time()
+        full = full or now - old.get("swept", 0) >= sweep
+        new = {"dirs": {}, "files": {}, "swept": now if full else old["swept"]}
+        changed = []
+
+        parts = pattern.split(os.sep)
+        i = 0
+        while i < len(parts) and not MAGIC.search(parts[i]):
+            i += 1
+
+        if i == len(parts):
+            # No wildcards, a single path
+            if os.path.exists(pattern):
+                self._check_file(pattern, os.stat(pattern), old, new, changed)
+        else:
+            root = os.sep.join(parts[:i]) or ("/" if pattern.startswith(os.sep) else "")
+            if os.path.isdir(root or "."):
+                self._walk(root, parts[i:], old, new, changed, full, now - settle)
+
+        if first and first_window is not None:
+            ago = (dt.datetime.now() - dt.timedelta(minutes=first_window)).timestamp()
+            changed = [p for p in changed if os.stat(p).st_ctime > ago]
+
+        self.pending[pattern] = new
+        return changed
+
+    # Leave files out of the state, so the next scan returns them again,
+    # e.g. files that are still being written
+    def defer(self, paths):
+        self.deferred.update(paths)
+        for new in self.pending.values():
+            for path in paths:
+                if new["files"].pop(path, None) is None:
+                    continue
+                # Check the directories of the file again on the next scan
+                dirpath = os.path.dirname(path)
+                while dirpath in new["dirs"]:
+                    new["dirs"][dirpath] = dict(new["dirs"][dirpath], settled=False)
+                    if dirpath == os.path.dirname(dirpath):
+                        break
+                    dirpath = os.path.dirname(dirpath)
+
+    def commit(self):
+        self.state.update(self.pending)
+        self.pending = {}
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        write_json(self.path, self.state)
+
+    # Returns True if the directory and everything below it has settled
+    def _walk(self, dirpath, rest, old, new, changed, full, before):
+        mtime = os.stat(dirpath or ".").st_mtime
+        cached = old["dirs"].get(dirpath)
+
+        if not full and cached and cached["mtime"] == mtime and cached.get("settled"):
+            self._reuse(dirpath, rest, old, new)
+            return True
+
+        settled = mtime < before
+        if not full and cached and cached["mtime"] == mtime:
+            # Nothing added or removed, reuse the entries from last time
+            entries = cached["entries"]
+            if len(rest) == 1:
+                # Stat the files, they may have been rewritten in place
+                for name in entries:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    self._check_file(path, st, old, new, changed)
+                    settled = settled and st.st_mtime < before
+        else:
+            entries = {}
+            with os.scandir(dirpath or ".") as it:
+                for entry in it:
+                    # Like glob, hidden files only match a pattern starting with "."
+                    if entry.name.startswith(".") and not rest[0].startswith("."):
+                        continue
+                    if not fnmatch.fnmatch(entry.name, rest[0]):
+                        continue
+                    path = os.path.join(dirpath, entry.name)
+                    try:
+                        if len(rest) == 1:
+                            st = entry.stat()
+                            self._check_file(path, st, old, new, changed)
+                            settled = settled and st.st_mtime < before
+                        entries[entry.name] = entry.is_dir()
+                    except OSError:
+                        # Broken link or file removed during the scan
+                        continue
+
+        if len(rest) > 1:
+            for name, is_dir in entries.items():
+                if is_dir:
+                    try:
+                        below = self._walk(os.path.join(dirpath, name), rest[1:], old, new, changed, full, before)
+                    except OSError:
+                        # Removed during the scan
+                        below = False
+                    settled = settled and below
+        new["dirs"][dirpath] = {"mtime": mtime, "entries": entries, "settled": settled}
+        return settled
+
+    # Copy the records of a settled subtree without touching the file system
+    def _reuse(self, dirpath, rest, old, new):
+        cached = old["dirs"][dirpath]
+        new["dirs"][dirpath] = cached
+        for name, is_dir in cached["entries"].items():
+            path = os.path.join(dirpath, name)
+            if len(rest) == 1:
+                if path in old["files"]:
+                    new["files"][path] = old["files"][path]
+            elif is_dir and path in old["dirs"]:
+                self._reuse(path, rest[1:], old, new)
+
+    def _check_file(self, path, st, old, new, changed):
+        record = [st.st_ino, st.st_size, st.st_mtime]
+        if old["files"].get(path) != record:
+            changed.append(path)
+        new["files"][path] = record
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# Stage graph runner for the cron wrappers.
+# Stages declare the stages they depend on. A stage starts as soon as all
+# its dependencies are done, so independent stages (CLC import, HCP upload,
+# GENSAM push) run at the same time on a thread pool. A failed stage only
+# skips the stages that depend on it, directly or not.
+# Stages wrapped in @log.log_error return the exception instead of raising,
+# a returned exception counts as a failure too, so does a sys.exit() in a stage.
+# With a RunState, a stage that completed in an earlier run with the same
+# input fingerprint is not run again ("done"), unless a stage it depends on
+# had to run. Volatile stages (e.g. a mirror sync) always run and don't force
+# their dependents to run, those rely on their own fingerprints.
+# Stages returning a list of paths have them recorded as outputs.
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+OK = "ok"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class StageGraph:
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger("stages")
+        self.stages = {}
+
+    # fingerprint: function returning a fingerprint of the stage inputs,
+    #              None means completing once per run is enough
+    # volatile: always run the stage
+    def add(self, name, func, deps=(), fingerprint=None, volatile=False):
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f'Stage {name} depends on unknown stage {dep}')
+        self.stages[name] = (func, tuple(deps), fingerprint, volatile)
+
+    def _call(self, name, func, fingerprint, reuse, state, run):
+        start = time.monotonic()
+        try:
+            key = fingerprint() if fingerprint else None
+            if reuse and state is not None and state.complete(run, name, key):
+                return DONE, None, time.monotonic() - start
+            result = func()
+            status = FAILED if isinstance(result, Exception) else OK
+        except (Exception, SystemExit) as e:
+            self.logger.exception(f'Stage {name} failed')
+            result, status, key = e, FAILED, None
+        seconds = time.monotonic() - start
+        if state is not None:
+            outputs = result if isinstance(result, list) and all(isinstance(r, str) for r in result) else []
+            state.set(run, name, status, key, outputs, seconds)
+        return status, result, seconds
+
+    # state, run: RunState and run key to skip stages completed in an earlier run
+    # Returns {name: {"status", "seconds", "result"}} in the order the stages were added
+    def run(self, workers=4, state=None, run=None):
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            while pending or running:
+                for name, (func, deps, fingerprint, volatile) in list(pending.items()):
+                    states = [results[dep]["status"] for dep in deps if dep in results]
+                    if any(status not in (OK, DONE) for status in states):
+                        failed = [dep for dep in deps if dep in results and results[dep]["status"] not in (OK, DONE)]
+                        self.logger.warning(f'Skipping stage {name}, {", ".join(failed)} did not complete')
+                        results[name] = {"status": SKIPPED, "seconds": 0.0, "result": None}
+                        del pending[name]
+                    elif len(states) == len(deps):
+                        self.logger.info(f'Starting stage {name}')
+                        # A stage whose inputs were just rebuilt runs again
+                        reuse = not volatile and all(results[dep]["status"] == DONE or self.stages[dep][3]
+                                                     for dep in deps)
+                        running[executor.submit(self._call, name, func, fingerprint, reuse, state, run)] = name
+                        del pending[name]
+
+                if not running:
+                    # Only skipped stages were left, loop once more to record them
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    status, result, seconds = future.result()
+                    results[name] = {"status": status, "seconds": seconds, "result": result}
+                    self.logger.info(f'Stage {name} {status} in {seconds:.1f} s')
+
+        return {name: results[name] for name in self.stages}
+
+
+def summary(results):
+    lines = [f"{'stage':<20} {'status':<8} {'seconds':>8}"]
+    for name, result in results.items():
+        lines.append(f"{name:<20} {result['status']:<8} {result['seconds']:8.1f}")
+    return "\n".join(lines)
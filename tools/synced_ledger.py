@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# Ledger of files synced to the microbiology outbox.
+# An SQLite database with the file name as primary key, so membership is an
+# index lookup, every add is its own transaction and the eurofins and
+# nextseq cron jobs can share it (WAL mode, waits on locks).
+# Each record has the content hash (sha256), the size and mtime of the
+# source when it was hashed and the time it was synced.
+#
+# Import the old flat text file:
+#   python -m tools.synced_ledger -t syncedFiles.txt -d syncedFiles.db
+
+import argparse
+import datetime
+import os
+import sqlite3
+
+
+# Ledger next to the old text file, e.g. syncedFiles.txt -> syncedFiles.db
+def ledger_path(syncedfiles):
+    return os.path.splitext(syncedfiles)[0] + ".db"
+
+
+class SyncedLedger:
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS synced ("
+                          "name TEXT PRIMARY KEY, sha256 TEXT, source TEXT, synced_at TEXT, size INTEGER, mtime REAL)")
+        # Ledgers created before size and mtime were recorded
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(synced)")]
+        for column, sqltype in (("size", "INTEGER"), ("mtime", "REAL")):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE synced ADD COLUMN {column} {sqltype}")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS synced_sha256 ON synced (sha256)")
+
+    def __contains__(self, name):
+        return self.conn.execute("SELECT 1 FROM synced WHERE name = ?", (name,)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM synced").fetchone()[0]
+
+    def get(self, name):
+        fields = ("name", "sha256", "source", "synced_at", "size", "mtime")
+        row = self.conn.execute(f"SELECT {', '.join(fields)} FROM synced WHERE name = ?", (name,)).fetchone()
+        return dict(zip(fields, row)) if row else None
+
+    # Names of synced files with this content
+    def names_with_digest(self, sha256):
+        return [row[0] for row in self.conn.execute("SELECT name FROM synced WHERE sha256 = ?", (sha256,))]
+
+    def add(self, name, sha256, source=None, size=None, mtime=None):
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO synced (name, sha256, source, synced_at, size, mtime) "
+                              "VALUES (?, ?, ?, ?, ?, ?)", (name, sha256, source, now, size, mtime))
+
+    # Names from the old syncedFiles.txt, without hash or time
+    def import_text(self, syncedfiles):
+        with open(syncedfiles) as sync_file:
+            names = [(name,) for name in sync_file.read().splitlines() if name]
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO synced (name) VALUES (?)", names)
+        return len(names)
+
+    def close(self):
+        self.conn.close()
+
+
+# Open the ledger for a syncedFiles.txt path, importing the text file the first time
+def open_ledger(syncedfiles):
+    path = ledger_path(syncedfiles)
+    new = not os.path.exists(path)
+    ledger = SyncedLedger(path)
+    if new and os.path.exists(syncedfiles):
+        ledger.import_text(syncedfiles)
+    return ledger
+
+
+def arg():
+    parser = argparse.ArgumentParser(prog="synced_ledger.py")
+    parser.add_argument("-t", "--textfile", required=True, help="old syncedFiles.txt to import")
+    parser.add_argument("-d", "--database", help="ledger to import into, default next to the text file")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = arg()
+    ledger = SyncedLedger(args.database or ledger_path(args.textfile))
+    count = ledger.import_text(args.textfile)
+    print(f"Imported {count} names, {len(ledger)} files in {ledger.path}")
+    ledger.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,18 @@ import logging
 import smtplib
 from email.message import EmailMessage
 import subprocess
-import glob
+from tools.scan_state import ScanState
+from tools.md5verify import verify_md5sums
+from tools.ftp_mirror import connect, mirror
 
-def main (logdir, dataloc, eurofinshost, username, password, no_mail, no_sync):
+
+# Raised instead of sys.exit, the eurofins wrapper runs the sync as a stage
+# and the watcher runs the wrapper in its own long running process
+class SyncError(Exception):
+    pass
+
+
+def main (logdir, dataloc, eurofinshost, username, password, no_mail, no_sync, engine="python", port=21, streams=4):
     #Run checks on all given inputs
     checkinput(logdir, dataloc)
 
@@ -22,6 +31,60 @@ def main (logdir, dataloc, eurofinshost, username, password, no_mail, no_sync):
     logger.info('Starting the FTP sync workflow.')
 
     #Sync the FTP
+    if engine == "lftp":
+        lftp_sync(dataloc, eurofinshost, username, password, no_mail, no_sync, logger, logfile)
+    else:
+        python_sync(dataloc, eurofinshost, port, username, password, no_mail, no_sync, streams, logger, logfile)
+
+    #Check the new md5sums which was downloaded
+    scanner = ScanState(os.path.join(logdir, "md5sums_scan_state.json"))
+    md5files = get_md5files(scanner, dataloc)
+
+    logger.info(f'Checking MD5 sums for downloaded files in {len(md5files)} directories.')
+    mismatches = verify_md5sums(md5files, cache=os.path.join(logdir, "md5_cache.json"))
+    for path, expected, found in mismatches:
+        if found is None:
+            logger.error(f'File listed in md5sums.txt is missing: {path}.')
+        else:
+            logger.error(f'Incorrect MD5 sum for {path}: expected {expected}, found {found}.')
+    if mismatches:
+        if not no_mail:
+            email_error(logfile, "MD5 SUM CHECK")
+        raise SyncError(f'{len(mismatches)} incorrect md5 sum(s) found.')
+    logger.info('All MD5 sums correct.')
+
+    # Only remember the md5sums files once all of them are checked
+    scanner.commit()
+
+    # Finish workflow
+    logger.info('Finished the FTP sync workflow')
+
+
+# Sync with the built in mirror engine, parallel transfers and resumable
+def python_sync(dataloc, eurofinshost, port, username, password, no_mail, no_sync, streams, logger, logfile):
+    try:
+        if no_sync:
+            logger.info('No-sync flag set. Testing the FTP connection')
+            connect(eurofinshost, port, username, password).quit()
+            logger.info('FTP connection OK.')
+            return
+
+        logger.info(f'Starting syncing of FTP folders to {dataloc}')
+        # Mirror state next to the logs, not in the data tree
+        summary = mirror(eurofinshost, port, username, password, dataloc, logger, streams=streams,
+                         statedir=os.path.dirname(logfile))
+        if summary["failed"]:
+            raise IOError(f'{len(summary["failed"])} file(s) failed to download')
+        logger.info(f'Completed FTP sync, {len(summary["downloaded"])} file(s) downloaded.')
+    except Exception as e:
+        logger.error(f'FTP sync failed: {e}')
+        if not no_mail:
+            email_error(logfile, "FTP SYNC")
+        raise SyncError('FTP sync failed.') from e
+
+
+# Sync with lftp mirror
+def lftp_sync(dataloc, eurofinshost, username, password, no_mail, no_sync, logger, logfile):
     if no_sync:
         logger.info('No-sync flag set. Testing the FTP connection')
         lftpcommand = ['lftp', '-u', f'{username},{password}', f'{eurofinshost}:21',
@@ -42,59 +105,35 @@ def main (logdir, dataloc, eurofinshost, username, password, no_mail, no_sync):
         logger.error('FTP sync failed.')
         if not no_mail:
             email_error(logfile, "FTP SYNC")
-        sys.exit('ERROR: FTP sync failed.')
-
-    #Check the new md5sums which was downloaded
-    md5files = get_md5files(now, dataloc)
-
-    for md5file in md5files:
-        md5path = os.path.dirname(md5file)
-        md5dir = os.path.basename(os.path.normpath(md5path))
-
-        md5command = ["md5sum", "-c", "--quiet", md5file]
-        logger.info(f'Checking MD5 sums for downloaded files in {md5dir}.')
-        try:
-            md5results = subprocess.run(md5command, cwd=md5path)
-            md5results.check_returncode()
-            logger.info(f'All MD5 sums correct for files in {md5dir}.')
-        except:
-            logger.error(f'Incorrect MD5 sum found in {md5file}.')
-            if not no_mail:
-                email_error(logfile, "MD5 SUM CHECK")
-            sys.exit(f'ERROR: Incorrect md5 sum found in {md5file}.')
-
-    # Finish workflow
-    logger.info('Finished the FTP sync workflow')
+        raise SyncError('FTP sync failed.')
 
 
 def checkinput(logdir, dataloc):
     #Check that the logdir is there and accesible
     if not os.path.exists(logdir):
-        sys.exit("ERROR: Can not find " + logdir + ". Perhaps you need to create it?")
+        raise SyncError("Can not find " + logdir + ". Perhaps you need to create it?")
     if not os.access(logdir, os.W_OK):
-        sys.exit("ERROR: No write permissions in " + logdir + ".")
+        raise SyncError("No write permissions in " + logdir + ".")
 
     #Check that the datalocation to write files to exist and has premissions
     if not os.path.exists(dataloc):
-        sys.exit("ERROR: Can not find " + dataloc + ". Perhaps you need to create it?")
+        raise SyncError("Can not find " + dataloc + ". Perhaps you need to create it?")
     if not os.access(logdir, os.W_OK):
-        sys.exit("ERROR: No write permissions in " + dataloc + ".")
+        raise SyncError("No write permissions in " + dataloc + ".")
 
 
-def get_md5files(now, dataloc):
-    ago = now-datetime.timedelta(minutes=720)
-    path_list = []
-    for path in glob.glob(f'{dataloc}/*/md5sums.txt', recursive=True):
-        st = os.stat(path)
-        mtime = datetime.datetime.fromtimestamp(st.st_ctime)
-        if mtime > ago:
-            path_list.append(path)
-    return path_list
+# New or changed md5sums files since the last successful check
+def get_md5files(scanner, dataloc):
+    return scanner.scan(f'{dataloc}/*/md5sums.txt')
 
 
 def setup_logger(name, log_path=None):
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
+    # The watcher syncs many times in one process, start a new log every sync
+    for handle in list(logger.handlers):
+        logger.removeHandler(handle)
+        handle.close()
 
     stream_handle = logging.StreamHandler()
     stream_handle.setLevel(logging.DEBUG)
@@ -126,4 +165,7 @@ def email_error(logloc, errorstep):
     s.quit()
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    except SyncError as e:
+        sys.exit(f'ERROR: {e}')
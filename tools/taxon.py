@@ -0,0 +1,11 @@
+#!/usr/bin/env python3
+
+# Shared taxon normalisation for pangolin lineage reports.
+# The taxon column holds the full fasta header, e.g. "Consensus_<sample>_<x>_<y>_..."
+# HCP and GENSAM only want the sample part, split("_")[1:4].
+
+
+def normalise_taxon(df, column="taxon"):
+    # One vectorized pass over the column instead of a replace() per row
+    df[column] = df[column].str.split("_").str[1:4].str.join("_")
+    return df
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# Change notification for the data directories.
+# Uses inotify through inotify_simple when it is installed, otherwise polls
+# the mtime of the watched directories. Each root is watched down to a
+# given depth, e.g. nextseq_data/<run>/<subdir> is depth 2. wait() returns
+# the roots that changed with the names of the top level entries under
+# them that changed (the run directories), "" for the root itself and
+# None when events were lost and anything under the root may have changed.
+
+import os
+import time
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+
+# Directories under root down to depth, as (path, depth)
+def walk_dirs(root, depth):
+    dirs = [(root, 0)]
+    i = 0
+    while i < len(dirs):
+        path, level = dirs[i]
+        i += 1
+        if level == depth:
+            continue
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False) and not entry.name.startswith("."):
+                        dirs.append((entry.path, level + 1))
+        except OSError:
+            continue
+    return dirs
+
+
+# Hidden and temporary files, e.g. .part downloads and atomic write temp files
+def ignored(name):
+    return name.startswith(".") or name.endswith((".tmp", ".part"))
+
+
+# Top level entry of root that path is in
+def top_entry(root, path):
+    rel = os.path.relpath(path, root)
+    return "" if rel == "." else rel.split(os.sep)[0]
+
+
+class PollWatcher:
+    def __init__(self, roots, interval=30):
+        # roots: {root: depth}
+        self.roots = roots
+        self.interval = interval
+        self.mtimes = self._snapshot()
+        self.polled = time.monotonic()
+
+    def _snapshot(self):
+        mtimes = {}
+        for root, depth in self.roots.items():
+            for path, level in walk_dirs(root, depth):
+                try:
+                    mtimes[path] = (root, os.stat(path).st_mtime)
+                except OSError:
+                    continue
+        return mtimes
+
+    def wait(self, timeout):
+        # Walk the trees every interval seconds, however often wait() is called
+        delay = self.interval - (time.monotonic() - self.polled)
+        if delay > timeout:
+            time.sleep(timeout)
+            return {}
+        time.sleep(max(delay, 0))
+        self.polled = time.monotonic()
+        mtimes = self._snapshot()
+        changes = {}
+        for path, (root, mtime) in mtimes.items():
+            old = self.mtimes.get(path)
+            if old is None or old[1] != mtime:
+                changes.setdefault(root, set()).add(top_entry(root, path))
+        for path, (root, mtime) in self.mtimes.items():
+            if path not in mtimes:
+                changes.setdefault(root, set()).add(top_entry(root, path))
+        self.mtimes = mtimes
+        return changes
+
+
+class InotifyWatcher:
+    def __init__(self, roots):
+        self.roots = roots
+        self.inotify = INotify()
+        self.mask = (flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO | flags.DELETE
+                     | flags.MOVED_FROM | flags.ATTRIB)
+        self.watches = {}
+        for root, depth in roots.items():
+            for path, level in walk_dirs(root, depth):
+                self._add(root, path, level)
+
+    def _add(self, root, path, level):
+        try:
+            wd = self.inotify.add_watch(path, self.mask)
+        except OSError:
+            return
+        self.watches[wd] = (root, path, level)
+
+    def wait(self, timeout):
+        changes = {}
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            if event.mask & flags.Q_OVERFLOW:
+                for root in self.roots:
+                    changes.setdefault(root, set()).add(None)
+                continue
+            if event.wd not in self.watches or ignored(event.name):
+                continue
+            root, path, level = self.watches[event.wd]
+            full = os.path.join(path, event.name)
+            changes.setdefault(root, set()).add(top_entry(root, full))
+            # New run or date directories are watched too, with what is already in them
+            if event.mask & flags.ISDIR and event.mask & (flags.CREATE | flags.MOVED_TO) \
+                    and level < self.roots[root] and not event.name.startswith("."):
+                for sub, sublevel in walk_dirs(full, self.roots[root] - level - 1):
+                    self._add(root, sub, level + 1 + sublevel)
+        return changes
+
+
+# inotify if available, else polling
+def watcher(roots, interval=30, poll=False):
+    if INotify is None or poll:
+        return PollWatcher(roots, interval)
+    return InotifyWatcher(roots)